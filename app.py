@@ -7,9 +7,10 @@ import jinja_partials
 from flask import Flask
 from flask_cors import CORS
 from flask_login import LoginManager
-from sqlalchemy import create_engine
 
-from models import Session, User, db
+import migrations
+from config import Config
+from models import Session, User, create_db_engine, db
 from routes import api, main
 from services import source_processors, audible
 
@@ -33,13 +34,21 @@ def config_app():
     app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db_path = os.path.join(app.instance_path, "clipnotes.db")
-    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+    app.config["SQLALCHEMY_DATABASE_URI"] = (
+        Config.DATABASE_URL or f"sqlite:///{db_path}"
+    )
+
+
+def init_db():
+    config_app()
+    engine = create_db_engine(app.config.get("SQLALCHEMY_DATABASE_URI"))
+    Session.configure(bind=engine)
+    db.init_app(app)
+    return engine
 
 
 def start_threads():
-    queue_thread = Thread(target=source_processors.process_queue)
-    queue_thread.daemon = True
-    queue_thread.start()
+    source_processors.start_pipeline()
 
     audible_thread = Thread(target=audible.sync_with_audible)
     audible_thread.daemon = True
@@ -48,29 +57,24 @@ def start_threads():
 
 @app.cli.command("create-db")
 def create_db():
-    config_app()
-    db.init_app(app)
-    db.create_all()
+    migrations.create(init_db())
+
+
+@app.cli.command("migrate-db")
+def migrate_db():
+    migrations.migrate(init_db())
 
 
 @app.cli.command("drop-db")
 def drop_db():
-    config_app()
-    db.init_app(app)
-    db.drop_all()
+    db.metadata.drop_all(init_db())
 
 
 @app.cli.command("audible-auth")
 @click.argument("email")
 @click.argument("password")
 def authenticate_audible(email: str, password: str):
-    config_app()
-    db_uri = app.config.get("SQLALCHEMY_DATABASE_URI")
-    engine = create_engine(
-        f"{db_uri}?check_same_thread=False",
-    )
-    Session.configure(bind=engine)
-    db.init_app(app)
+    init_db()
     audible.save_audible_auth_to_file(email, password)
 
 
@@ -79,18 +83,23 @@ def load_user(user):
     return User.get_by_id(int(user))
 
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    Session.remove()
+
+
 def create_app():
     login_manager.init_app(app)
 
-    config_app()
-    db_uri = app.config.get("SQLALCHEMY_DATABASE_URI")
-    engine = create_engine(
-        f"{db_uri}?check_same_thread=False",
-    )
-    Session.configure(bind=engine)
+    engine = init_db()
+    version = migrations.get_engine_version(engine)
+    if version < migrations.LATEST_VERSION:
+        raise RuntimeError(
+            f"The database schema is at version {version} of "
+            f"{migrations.LATEST_VERSION}. Run flask migrate-db before starting."
+        )
     app.register_blueprint(main)
     app.register_blueprint(api)
-    db.init_app(app)
     jinja_partials.register_extensions(app)
 
     start_threads()
@@ -1,6 +1,49 @@
+import os
+
+
 class Config:
     TMP_DIRECTORY = "./tmp"
     TMP_MAX_SIZE = 100 * 1000 * 1000
     AUDIBLE_DIRECTORY = "./audible"
     AUDIBLE_MAX_SIZE = 1000 * 1000 * 1000
     AUDIBLE_SYNC_SECONDS = 60 * 60
+    AUDIBLE_CONVERT_TO_M4B = False
+    AUDIBLE_SYNC_CONCURRENCY = 8
+    AUDIBLE_SYNC_USERS = 4
+    AUDIBLE_INGEST_BATCH_SIZE = 500
+    AUDIBLE_SYNC_MAX_BACKOFF_SECONDS = 24 * 60 * 60
+    AUDIBLE_SCHEDULER_TICK_SECONDS = 60
+    AUDIBLE_LIBRARY_PAGE_SIZE = 200
+    AUDIBLE_LIBRARY_REFRESH_SECONDS = 6 * 60 * 60
+    DOWNLOAD_WORKERS = 2
+    CLIP_WORKERS = 2
+    TRANSCRIBE_WORKERS = 2
+    STAGE_QUEUE_SIZE = 4
+    QUEUE_POLL_SECONDS = 60
+    CLIP_BATCH_SIZE = 50
+    WHISPER_MODEL = "base"
+    TRANSCRIBE_PROCESSES = 2
+    WHISPER_THREADS = max(1, (os.cpu_count() or 1) // TRANSCRIBE_PROCESSES)
+    PARTIAL_DOWNLOADS = True
+    PARTIAL_DOWNLOAD_MARGIN = 30
+    # Shorter sources are downloaded whole and cached
+    PARTIAL_DOWNLOAD_MIN_DURATION = 20 * 60
+    DOWNLOAD_TIMEOUT = 30
+    DOWNLOAD_RETRIES = 5
+    DOWNLOAD_POOL_SIZE = 10
+    DOWNLOAD_SEGMENTS = 4
+    SEGMENTED_DOWNLOAD_MIN_SIZE = 50 * 1000 * 1000
+    # Defaults to SQLite in the instance folder when unset
+    DATABASE_URL = os.getenv("DATABASE_URL")
+    DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 10))
+    DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+    DATABASE_POOL_TIMEOUT = int(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+    SQLITE_BUSY_TIMEOUT_MS = 5000
+    SQLITE_CACHE_SIZE_KB = 64 * 1024
+    SOURCES_PAGE_SIZE = 20
+    SOURCES_MAX_PAGE_SIZE = 100
+    API_KEY_CACHE_SECONDS = 5 * 60
+    MARKDOWN_CACHE_SECONDS = 60
+    MARKDOWN_CACHE_SIZE = 1000
+    TRACE_METHODS = False
+    TRACE_SAMPLE_RATE = 1.0
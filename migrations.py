@@ -0,0 +1,186 @@
+import logging
+
+from sqlalchemy import Connection, Engine, inspect, select, text
+
+from models import db
+
+# The version of the schema a database is at. New databases are created at
+# the latest version; existing ones are brought up to it by migrate-db.
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, nullable=False),
+)
+
+
+def add_query_indexes(connection: Connection):
+    for statement in [
+        "CREATE INDEX IF NOT EXISTS ix_snippet_status_created_at "
+        "ON snippet (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_snippet_user_id_status_created_at "
+        "ON snippet (user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_snippet_user_id_status_source_id "
+        "ON snippet (user_id, status, source_id)",
+        "CREATE INDEX IF NOT EXISTS ix_snippet_source_id_created_at "
+        "ON snippet (source_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_sync_record_user_id_source_id_synced_at "
+        "ON sync_record (user_id, source_id, synced_at)",
+        "CREATE INDEX IF NOT EXISTS ix_user_settings_user_id_name "
+        "ON user_settings (user_id, name)",
+        "CREATE INDEX IF NOT EXISTS ix_device_last_four ON device (last_four)",
+        "CREATE INDEX IF NOT EXISTS ix_audible_snippet_id ON audible (snippet_id)",
+        "CREATE INDEX IF NOT EXISTS ix_audible_sync_record_user_id "
+        "ON audible_sync_record (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_audible_book_state_user_id_asin "
+        "ON audible_book_state (user_id, asin)",
+    ]:
+        connection.execute(text(statement))
+
+
+def add_natural_key_constraints(connection: Connection):
+    """
+    Removes duplicate rows, then makes the natural keys unique so they can be
+    upserted. The oldest duplicate snippet and the latest sync are kept.
+    """
+    for statement in [
+        """
+        DELETE FROM audible WHERE snippet_id IN (
+            SELECT id FROM snippet WHERE id NOT IN (
+                SELECT MIN(id) FROM snippet
+                GROUP BY user_id, source_id, start_time, end_time
+            )
+        )
+        """,
+        """
+        DELETE FROM snippet WHERE id NOT IN (
+            SELECT MIN(id) FROM snippet
+            GROUP BY user_id, source_id, start_time, end_time
+        )
+        """,
+        """
+        DELETE FROM sync_record WHERE id NOT IN (
+            SELECT MAX(id) FROM sync_record AS latest
+            WHERE latest.synced_at = (
+                SELECT MAX(synced_at) FROM sync_record AS other
+                WHERE other.user_id = latest.user_id
+                AND other.source_id = latest.source_id
+            )
+            GROUP BY user_id, source_id
+        )
+        """,
+        """
+        DELETE FROM audible_sync_record WHERE id NOT IN (
+            SELECT MAX(id) FROM audible_sync_record AS latest
+            WHERE latest.synced_at = (
+                SELECT MAX(synced_at) FROM audible_sync_record AS other
+                WHERE other.user_id = latest.user_id
+            )
+            GROUP BY user_id
+        )
+        """,
+        "DROP INDEX IF EXISTS ix_sync_record_user_id_source_id_synced_at",
+        "DROP INDEX IF EXISTS ix_audible_sync_record_user_id",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_snippet_user_id_source_id_times "
+        "ON snippet (user_id, source_id, start_time, end_time)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_sync_record_user_id_source_id "
+        "ON sync_record (user_id, source_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_audible_sync_record_user_id "
+        "ON audible_sync_record (user_id)",
+    ]:
+        connection.execute(text(statement))
+
+
+def add_audible_library_books(connection: Connection):
+    # The table itself is created from the models
+    connection.execute(
+        text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_audible_library_book_user_id_asin "
+            "ON audible_library_book (user_id, asin)"
+        )
+    )
+
+
+def add_source_activity(connection: Connection):
+    """
+    Fills in the latest DONE snippet of each user's sources. The table itself
+    is created from the models.
+    """
+    for statement in [
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_source_activity_user_id_source_id "
+        "ON source_activity (user_id, source_id)",
+        "CREATE INDEX IF NOT EXISTS ix_source_activity_user_id_latest_snippet_id "
+        "ON source_activity (user_id, latest_snippet_id)",
+        """
+        INSERT INTO source_activity (user_id, source_id, latest_snippet_id)
+        SELECT user_id, source_id, MAX(id) FROM snippet
+        WHERE status = 'DONE'
+        GROUP BY user_id, source_id
+        ON CONFLICT (user_id, source_id) DO NOTHING
+        """,
+    ]:
+        connection.execute(text(statement))
+
+
+# Migrations run in order and each one's version is its position in this list,
+# starting at 1. Append new migrations, never reorder or remove them. Tables
+# missing from a database are created from the models before migrating, so a
+# migration must tolerate its changes already being there. Migrations spell
+# out their own SQL rather than using the models, which keep changing.
+MIGRATIONS = [
+    add_query_indexes,
+    add_natural_key_constraints,
+    add_audible_library_books,
+    add_source_activity,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(connection: Connection) -> int:
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+    version = connection.execute(select(schema_version.c.version)).scalar()
+    return version or 0
+
+
+def get_engine_version(engine: Engine) -> int:
+    with engine.connect() as connection:
+        return get_version(connection)
+
+
+def set_version(connection: Connection, version: int):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def stamp(engine: Engine, version: int = LATEST_VERSION):
+    with engine.begin() as connection:
+        schema_version.create(connection, checkfirst=True)
+        set_version(connection, version)
+
+
+def migrate(engine: Engine):
+    """
+    Applies the migrations the database hasn't had yet, each in its own
+    transaction along with the version bump.
+    """
+    db.metadata.create_all(engine)
+    version = get_engine_version(engine)
+
+    for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating database to version {version}: {migration.__name__}")
+        with engine.begin() as connection:
+            migration(connection)
+            set_version(connection, version)
+
+
+def create(engine: Engine):
+    """
+    Creates the schema at the latest version in an empty database. A database
+    that already has tables is migrated instead, since creating tables leaves
+    the existing ones without their newer indexes.
+    """
+    if inspect(engine).get_table_names():
+        migrate(engine)
+        return
+    db.metadata.create_all(engine)
+    stamp(engine)
@@ -1,21 +1,72 @@
 from __future__ import annotations
+from typing import Optional
 from typing_extensions import Self
-import logging
-import inspect
+import hashlib
+import time
 from dataclasses import dataclass
-from typing import Any
 from urllib.parse import urlparse
 from enum import Enum, unique
+from threading import Lock
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import and_
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker, scoped_session
+from sqlalchemy import Engine, and_, create_engine, event, make_url
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import check_password_hash
 
+from config import Config
+from services import tracing
+
 db = SQLAlchemy()
+# Each thread gets its own session. Requests remove theirs on teardown and
+# background threads after each unit of work, so no session outlives the
+# work it was opened for.
 Session = scoped_session(sessionmaker())
 
+# sha256 of verified API keys -> (device id, user id, expiry)
+_verified_keys: dict[str, tuple[int, int, float]] = {}
+_verified_keys_lock = Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers carry on while a writer commits
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+
+
+def create_db_engine(db_uri: str) -> Engine:
+    pool_args = {
+        "pool_size": Config.DATABASE_POOL_SIZE,
+        "max_overflow": Config.DATABASE_MAX_OVERFLOW,
+        "pool_timeout": Config.DATABASE_POOL_TIMEOUT,
+    }
+    if make_url(db_uri).get_backend_name() != "sqlite":
+        return create_engine(db_uri, pool_pre_ping=True, **pool_args)
+
+    engine = create_engine(
+        db_uri,
+        connect_args={"check_same_thread": False},
+        **pool_args,
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+# Bulk statements on sources and snippets record the ids of the sources they
+# change under this key of the session's info, for caches kept per source.
+# Statements that have done so run with the RECORDS_SOURCES option.
+CHANGED_SOURCES = "changed_sources"
+RECORDS_SOURCES = "records_sources"
+
+
+def record_changed_sources(source_ids):
+    Session.info.setdefault(CHANGED_SOURCES, set()).update(source_ids)
+
 
 def url_without_query(url):
     parsed_url = urlparse(url)
@@ -38,7 +89,26 @@ class SnippetStatus(Enum):
     DONE = 5
     ERROR = 6
 
+    @property
+    def progress(self) -> int:
+        """
+        How far through the pipeline a snippet is, as a percentage. The values
+        predate the order the stages run in, so they can't be used for this.
+        """
+        return _STATUS_PROGRESS[self]
+
+
+_STATUS_PROGRESS = {
+    SnippetStatus.QUEUED: 20,
+    SnippetStatus.DOWNLOADING: 40,
+    SnippetStatus.PROCESSING: 60,
+    SnippetStatus.TRANSCRIBING: 80,
+    SnippetStatus.DONE: 100,
+    SnippetStatus.ERROR: 100,
+}
 
+
+@tracing.trace_methods
 class BaseModel:
     __allow_unmapped__ = True
 
@@ -54,15 +124,65 @@ class BaseModel:
     def find_by_id(cls, id) -> Self:
         return Session.query(cls).get(id)
 
-    def __getattribute__(self, __name: str) -> Any:
-        returned = object.__getattribute__(self, __name)
-        if inspect.isfunction(returned) or inspect.ismethod(returned):
-            logging.debug(f"Calling {__name} on {self}")
-        return returned
+    @classmethod
+    def dialect_insert(cls):
+        """
+        Returns an INSERT for cls in the database's dialect, which supports
+        ON CONFLICT clauses.
+        """
+        if Session.get_bind().dialect.name == "postgresql":
+            return postgresql.insert(cls)
+        return sqlite.insert(cls)
+
+    @classmethod
+    def upsert(
+        cls,
+        values: dict,
+        conflict_columns: list[str],
+        update: Optional[dict] = None,
+    ) -> Self:
+        """
+        Inserts a row, or applies update to the row that already has the same
+        conflict_columns, in a single INSERT ... ON CONFLICT statement. Without
+        an update the existing row is returned unchanged.
+        The row is detached before committing so it keeps the values the
+        statement returned instead of being reloaded on first access, then
+        merged back in without a query so changes to it are saved.
+        """
+        statement = cls.dialect_insert().values(values)
+        if not update:
+            # A no-op update rather than DO NOTHING, so the row is returned
+            column = conflict_columns[0]
+            update = {column: statement.excluded[column]}
+        statement = statement.on_conflict_do_update(
+            index_elements=conflict_columns, set_=update
+        ).returning(cls)
+        row = Session.scalars(
+            statement,
+            execution_options={"populate_existing": True, RECORDS_SOURCES: True},
+        ).one()
+        record_changed_sources(row.changed_source_ids())
+        Session.expunge(row)
+        Session.commit()
+        return Session.merge(row, load=False)
+
+    def changed_source_ids(self) -> tuple[int, ...]:
+        """
+        The sources whose content changes along with this row.
+        """
+        return ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tracing.trace_methods(cls)
 
 
 @dataclass
 class AudibleSyncRecord(db.Model, BaseModel):
+    __table_args__ = (
+        db.Index("uq_audible_sync_record_user_id", "user_id", unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     synced_at = db.Column(db.DateTime, default=db.func.now())
@@ -77,19 +197,110 @@ class AudibleSyncRecord(db.Model, BaseModel):
 
     @staticmethod
     def update_user_sync_record(user_id: int):
-        record = Session.query(AudibleSyncRecord).filter_by(user_id=user_id).first()
-        if record:
-            record.synced_at = db.func.now()
-            Session.commit()
-        else:
-            record = AudibleSyncRecord(user_id=user_id)
-            record.add_to_db()
+        AudibleSyncRecord.upsert(
+            {"user_id": user_id, "synced_at": db.func.now()},
+            ["user_id"],
+            {"synced_at": db.func.now()},
+        )
+
+
+@dataclass
+class AudibleBookState(db.Model, BaseModel):
+    __table_args__ = (
+        db.Index("ix_audible_book_state_user_id_asin", "user_id", "asin"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    asin = db.Column(db.String(10), nullable=False)
+    annotation_state = db.Column(db.String(80), nullable=False)
+
+    @staticmethod
+    def find_user_states(user_id: int) -> dict[str, str]:
+        states = Session.query(AudibleBookState).filter_by(user_id=user_id).all()
+        return {state.asin: state.annotation_state for state in states}
+
+    @staticmethod
+    def update_user_states(user_id: int, states: dict[str, str]):
+        existing = {
+            state.asin: state
+            for state in Session.query(AudibleBookState)
+            .filter_by(user_id=user_id)
+            .filter(AudibleBookState.asin.in_(states))
+            .all()
+        }
+        for asin, annotation_state in states.items():
+            if asin in existing:
+                existing[asin].annotation_state = annotation_state
+            else:
+                Session.add(
+                    AudibleBookState(
+                        user_id=user_id,
+                        asin=asin,
+                        annotation_state=annotation_state,
+                    )
+                )
+        Session.commit()
+
+
+# A book that has been seen in a user's Audible library listing
+@dataclass
+class AudibleLibraryBook(db.Model, BaseModel):
+    __table_args__ = (
+        db.Index(
+            "uq_audible_library_book_user_id_asin", "user_id", "asin", unique=True
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    asin = db.Column(db.String(10), nullable=False)
+
+    @staticmethod
+    def find_user_asins(user_id: int) -> set[str]:
+        books = Session.query(AudibleLibraryBook.asin).filter_by(user_id=user_id)
+        return {asin for asin, in books}
+
+    @staticmethod
+    def add_user_asins(user_id: int, asins: set[str]):
+        if not asins:
+            return
+        Session.execute(
+            AudibleLibraryBook.dialect_insert()
+            .values([{"user_id": user_id, "asin": asin} for asin in asins])
+            .on_conflict_do_nothing(index_elements=["user_id", "asin"])
+        )
+        Session.commit()
 
 
 @dataclass
 class Snippet(db.Model, BaseModel):
     start_time: int
 
+    __table_args__ = (
+        # Claiming the oldest QUEUED snippet
+        db.Index("ix_snippet_status_created_at", "status", "created_at"),
+        # A user's queue, oldest first
+        db.Index(
+            "ix_snippet_user_id_status_created_at", "user_id", "status", "created_at"
+        ),
+        # A user's DONE snippets of the sources on a dashboard page
+        db.Index(
+            "ix_snippet_user_id_status_source_id", "user_id", "status", "source_id"
+        ),
+        # A source's snippets, and those since the last sync for markdown
+        db.Index("ix_snippet_source_id_created_at", "source_id", "created_at"),
+        # A user clips each stretch of a source once
+        db.Index(
+            "uq_snippet_user_id_source_id_times",
+            "user_id",
+            "source_id",
+            "start_time",
+            "end_time",
+            unique=True,
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     source_id = db.Column(db.Integer, db.ForeignKey("source.id"), nullable=False)
@@ -103,32 +314,33 @@ class Snippet(db.Model, BaseModel):
     def __repr__(self):
         return f"<Snippet {self.id} - {self.text}>"
 
+    def changed_source_ids(self) -> tuple[int, ...]:
+        return (self.source_id,)
+
     @staticmethod
     def add(user_id: int, source_id: int, start_time: int, end_time: int):
-        existing = (
-            Session.query(Snippet)
-            .filter_by(
-                user_id=user_id,
-                source_id=source_id,
-                start_time=start_time,
-                end_time=end_time,
-            )
-            .first()
+        return Snippet.upsert(
+            {
+                "user_id": user_id,
+                "source_id": source_id,
+                "start_time": start_time,
+                "end_time": end_time,
+            },
+            ["user_id", "source_id", "start_time", "end_time"],
         )
-        if existing:
-            return existing
-
-        snippet = Snippet(
-            user_id=user_id,
-            source_id=source_id,
-            start_time=start_time,
-            end_time=end_time,
-        )
-        snippet.add_to_db()
-        return snippet
 
     def update_status(self, status: SnippetStatus):
         self.status = status
+        if status == SnippetStatus.DONE:
+            Session.flush()
+            SourceActivity.record_done([self.id])
+        Session.commit()
+
+    def delete_from_db(self):
+        user_id, source_id = self.user_id, self.source_id
+        Session.delete(self)
+        Session.flush()
+        SourceActivity.refresh(user_id, source_id)
         Session.commit()
 
     def get_source_url(self):
@@ -161,37 +373,98 @@ class Snippet(db.Model, BaseModel):
         )
         snippet_queue = (
             Session.query(Snippet)
+            .options(joinedload(Snippet.source))
             .filter(filter)
             .order_by(Snippet.created_at)
             .limit(5)
             .all()
         )
         for snippet in snippet_queue:
-            snippet.url = snippet.get_source_url()
+            snippet.url = snippet.source.url
         return snippet_queue
 
     @staticmethod
-    def get_next_in_queue():
-        # TODO Make MAX_CONCURRENT_JOBS configurable
-        MAX_CONCURRENT_JOBS = 1
-        filter = and_(
-            Snippet.status != SnippetStatus.DONE,
-            Snippet.status != SnippetStatus.QUEUED,
+    def set_status(snippet_ids: list[int], status: SnippetStatus):
+        source_ids = Session.scalars(
+            db.update(Snippet)
+            .where(Snippet.id.in_(snippet_ids))
+            .values(status=status)
+            .returning(Snippet.source_id),
+            execution_options={"synchronize_session": False, RECORDS_SOURCES: True},
         )
-        num_in_progress = Session.query(Snippet).filter(filter).count()
-        if num_in_progress >= MAX_CONCURRENT_JOBS:
-            return None
+        record_changed_sources(source_ids)
+        if status == SnippetStatus.DONE:
+            SourceActivity.record_done(snippet_ids)
+        Session.commit()
 
-        return (
-            Session.query(Snippet)
-            .filter_by(status=SnippetStatus.QUEUED)
-            .order_by(Snippet.created_at)
-            .first()
-        )
+    @staticmethod
+    def claim_next_source_batch() -> list[Snippet]:
+        """
+        Atomically moves the QUEUED snippets of the oldest queued source to
+        DOWNLOADING and returns them, so the source only has to be fetched once.
+        At most Config.CLIP_BATCH_SIZE snippets are claimed at a time, oldest
+        first, since they're all clipped by one ffmpeg run.
+        The status check in the UPDATE guarantees that two workers racing for
+        the same rows can't both claim them; the loser rolls back and retries.
+        On PostgreSQL the rows are locked with SKIP LOCKED as they're read, so
+        workers on other nodes pass over them instead of racing at all.
+        """
+        while True:
+            source_id = (
+                Session.query(Snippet.source_id)
+                .filter_by(status=SnippetStatus.QUEUED)
+                .order_by(Snippet.created_at)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar()
+            )
+            if source_id is None:
+                Session.rollback()
+                return []
+
+            snippet_ids = [
+                snippet_id
+                for snippet_id, in Session.query(Snippet.id)
+                .filter_by(source_id=source_id, status=SnippetStatus.QUEUED)
+                .order_by(Snippet.created_at, Snippet.id)
+                .limit(Config.CLIP_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+                .all()
+            ]
+            if not snippet_ids:
+                # Another worker claimed the source after it was picked
+                Session.rollback()
+                continue
+            claimed = (
+                Session.query(Snippet)
+                .filter(
+                    Snippet.id.in_(snippet_ids),
+                    Snippet.status == SnippetStatus.QUEUED,
+                )
+                .execution_options(**{RECORDS_SOURCES: True})
+                .update(
+                    {Snippet.status: SnippetStatus.DOWNLOADING},
+                    synchronize_session=False,
+                )
+            )
+            if claimed != len(snippet_ids):
+                Session.rollback()
+                continue
+
+            record_changed_sources([source_id])
+            Session.commit()
+            return (
+                Session.query(Snippet)
+                .filter(Snippet.id.in_(snippet_ids))
+                .order_by(Snippet.start_time)
+                .all()
+            )
 
 
 @dataclass
 class Audible(db.Model, BaseModel):
+    __table_args__ = (db.Index("ix_audible_snippet_id", "snippet_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
     # TODO Look up ForeignKey vs relationship, etc.
     snippet_id = db.Column(db.Integer, db.ForeignKey("snippet.id"), nullable=False)
@@ -205,6 +478,77 @@ class Audible(db.Model, BaseModel):
         )
         audible_db.add_to_db()
 
+    @staticmethod
+    def bulk_add(user_id: int, clips: list[dict]) -> int:
+        """
+        Adds the sources, snippets and Audible rows for a batch of clips in a
+        single transaction, skipping clips the user already has.
+        Each clip is a dict with url, title, thumb_url, asin, start_time and
+        end_time. Returns the number of new snippets.
+        Sources and snippets are inserted with ON CONFLICT DO NOTHING on their
+        natural keys, so a concurrent add of the same clip is skipped rather
+        than failing the batch.
+        """
+        if not clips:
+            return 0
+        sources = {}
+        for clip in clips:
+            clip["url"] = url_without_query(clip["url"])
+            sources[clip["url"]] = {
+                "url": clip["url"],
+                "title": clip["title"],
+                "provider": SourceProvider.AUDIBLE,
+                "thumb_url": clip["thumb_url"],
+            }
+        # New sources have no content yet, and existing ones are left alone
+        Session.execute(
+            Source.dialect_insert()
+            .values(list(sources.values()))
+            .on_conflict_do_nothing(index_elements=["url"]),
+            execution_options={RECORDS_SOURCES: True},
+        )
+        source_ids = dict(
+            Session.query(Source.url, Source.id).filter(Source.url.in_(sources))
+        )
+
+        snippets = {}
+        for clip in clips:
+            source_id = source_ids[clip["url"]]
+            key = (source_id, clip["start_time"], clip["end_time"])
+            snippets[key] = (
+                {
+                    "user_id": user_id,
+                    "source_id": source_id,
+                    "start_time": clip["start_time"],
+                    "end_time": clip["end_time"],
+                },
+                clip["asin"],
+            )
+        new_snippets = Session.execute(
+            Snippet.dialect_insert()
+            .values([values for values, _ in snippets.values()])
+            .on_conflict_do_nothing(
+                index_elements=["user_id", "source_id", "start_time", "end_time"]
+            )
+            .returning(
+                Snippet.id, Snippet.source_id, Snippet.start_time, Snippet.end_time
+            ),
+            execution_options={RECORDS_SOURCES: True},
+        ).all()
+        record_changed_sources(source_id for _, source_id, *_ in new_snippets)
+
+        if new_snippets:
+            Session.execute(
+                Audible.dialect_insert().values(
+                    [
+                        {"snippet_id": snippet_id, "asin": snippets[tuple(key)][1]}
+                        for snippet_id, *key in new_snippets
+                    ]
+                )
+            )
+        Session.commit()
+        return len(new_snippets)
+
     @staticmethod
     def get_audible_data(snippet_id) -> Audible:
         # TODO Look up filter_by vs where
@@ -219,13 +563,18 @@ class Source(db.Model, BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(255), nullable=False, unique=True)
     title = db.Column(db.String(255))
-    snippets = db.relationship("Snippet", backref="source")
+    snippets = db.relationship(
+        "Snippet", backref="source", order_by="Snippet.start_time"
+    )
     thumb_url = db.Column(db.String(255))
     provider = db.Column(db.Enum(SourceProvider))
 
     def __repr__(self):
         return f"<Source {self.id} - {self.title}>"
 
+    def changed_source_ids(self) -> tuple[int, ...]:
+        return (self.id,)
+
     @staticmethod
     def add(
         url,
@@ -234,39 +583,59 @@ class Source(db.Model, BaseModel):
         thumb_url: str = None,
     ):
         url = url_without_query(url)
-        existing = Session.query(Source).filter_by(url=url).first()
-        if existing:
-            return existing
-
-        source = Source(url=url)
-        source.provider = provider
-        source.title = title
-        source.thumb_url = thumb_url
         parsed_url = urlparse(url)
         if provider is None:
             if parsed_url.hostname in ["www.youtube.com", "youtu.be"]:
-                source.provider = SourceProvider.YOUTUBE
+                provider = SourceProvider.YOUTUBE
             elif parsed_url.hostname in ["pca.st"]:
-                source.provider = SourceProvider.POCKETCASTS
-        source.add_to_db()
-        return source
+                provider = SourceProvider.POCKETCASTS
+        return Source.upsert(
+            {
+                "url": url,
+                "provider": provider,
+                "title": title,
+                "thumb_url": thumb_url,
+            },
+            ["url"],
+        )
 
     @classmethod
-    def get_user_sources_snippets(cls, user_id):
+    def get_user_sources_snippets(cls, user_id, cursor=None, limit=None):
+        """
+        Returns a page of the sources with DONE snippets for the user, most
+        recently clipped first, with source.snippets loaded and limited to the
+        user's DONE snippets. Always runs two queries, however many sources
+        there are.
+        Pages are keyed by the id of each source's latest DONE snippet, stored
+        in SourceActivity, so each page is a range scan of its index. Returns
+        the sources and the cursor for the next page, or None on the last page.
+        """
         filter = and_(
             Snippet.user_id == user_id,
             Snippet.status == SnippetStatus.DONE,
         )
-        sources = (
-            Session.query(Source)
-            .join(Snippet)
-            .filter(filter)
-            .order_by(Snippet.created_at.desc())
+        latest_id = SourceActivity.latest_snippet_id.label("latest_id")
+        query = (
+            Session.query(Source, latest_id)
+            .join(SourceActivity, Source.id == SourceActivity.source_id)
+            .filter(SourceActivity.user_id == user_id)
+        )
+        if cursor is not None:
+            query = query.filter(SourceActivity.latest_snippet_id < cursor)
+        query = query.order_by(SourceActivity.latest_snippet_id.desc())
+        if limit:
+            query = query.limit(limit)
+        rows = (
+            query.options(selectinload(Source.snippets.and_(filter)))
+            .populate_existing()
             .all()
         )
-        for source in sources:
-            source.snippets.sort(key=lambda x: x.start_time, reverse=False)
-        return sources
+
+        sources = [source for source, _ in rows]
+        next_cursor = None
+        if limit and len(rows) == limit:
+            next_cursor = rows[-1].latest_id
+        return sources, next_cursor
 
     def update_title(self, title):
         self.title = title
@@ -300,6 +669,12 @@ class SyncRecord(db.Model, BaseModel):
     source_id: int
     synced_at: str
 
+    __table_args__ = (
+        db.Index(
+            "uq_sync_record_user_id_source_id", "user_id", "source_id", unique=True
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     source_id = db.Column(db.Integer, db.ForeignKey("source.id"), nullable=False)
@@ -323,11 +698,112 @@ class SyncRecord(db.Model, BaseModel):
             .first()
         )
 
+    @staticmethod
+    def update_user_source(user_id, source_id) -> SyncRecord:
+        return SyncRecord.upsert(
+            {"user_id": user_id, "source_id": source_id, "synced_at": db.func.now()},
+            ["user_id", "source_id"],
+            {"synced_at": db.func.now()},
+        )
+
+    def changed_source_ids(self) -> tuple[int, ...]:
+        return (self.source_id,)
+
     def update_sync_time(self, time=db.func.now()):
         self.synced_at = time
         Session.commit()
 
 
+# The latest DONE snippet of each of a user's sources, which orders the
+# dashboard
+@dataclass
+class SourceActivity(db.Model, BaseModel):
+    __table_args__ = (
+        db.Index(
+            "uq_source_activity_user_id_source_id",
+            "user_id",
+            "source_id",
+            unique=True,
+        ),
+        # Paging through a user's sources, most recently clipped first
+        db.Index(
+            "ix_source_activity_user_id_latest_snippet_id",
+            "user_id",
+            "latest_snippet_id",
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    source_id = db.Column(db.Integer, db.ForeignKey("source.id"), nullable=False)
+    latest_snippet_id = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def record_done(snippet_ids: list[int]):
+        """
+        Moves the sources of snippets that reached DONE up to them, in the
+        caller's transaction.
+        """
+        latest = (
+            Session.query(Snippet.user_id, Snippet.source_id, db.func.max(Snippet.id))
+            .filter(
+                Snippet.id.in_(snippet_ids),
+                Snippet.status == SnippetStatus.DONE,
+            )
+            .group_by(Snippet.user_id, Snippet.source_id)
+            .all()
+        )
+        if not latest:
+            return
+        statement = SourceActivity.dialect_insert().values(
+            [
+                {
+                    "user_id": user_id,
+                    "source_id": source_id,
+                    "latest_snippet_id": snippet_id,
+                }
+                for user_id, source_id, snippet_id in latest
+            ]
+        )
+        excluded_id = statement.excluded.latest_snippet_id
+        Session.execute(
+            statement.on_conflict_do_update(
+                index_elements=["user_id", "source_id"],
+                set_={
+                    "latest_snippet_id": db.case(
+                        (
+                            excluded_id > SourceActivity.latest_snippet_id,
+                            excluded_id,
+                        ),
+                        else_=SourceActivity.latest_snippet_id,
+                    )
+                },
+            )
+        )
+
+    @staticmethod
+    def refresh(user_id: int, source_id: int):
+        """
+        Recomputes the user's latest DONE snippet for the source, e.g. after a
+        snippet is deleted, in the caller's transaction.
+        """
+        latest_id = (
+            Session.query(db.func.max(Snippet.id))
+            .filter_by(user_id=user_id, source_id=source_id, status=SnippetStatus.DONE)
+            .scalar()
+        )
+        activity = Session.query(SourceActivity).filter_by(
+            user_id=user_id, source_id=source_id
+        )
+        if latest_id is None:
+            activity.delete(synchronize_session=False)
+        else:
+            activity.update(
+                {SourceActivity.latest_snippet_id: latest_id},
+                synchronize_session=False,
+            )
+
+
 @dataclass
 class User(db.Model, UserMixin, BaseModel):
     id = db.Column(db.Integer, primary_key=True)
@@ -357,6 +833,8 @@ class User(db.Model, UserMixin, BaseModel):
 
 
 class UserSettings(db.Model, BaseModel):
+    __table_args__ = (db.Index("ix_user_settings_user_id_name", "user_id", "name"),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     name = db.Column(db.String(80), nullable=False)
@@ -400,11 +878,13 @@ class UserSettings(db.Model, BaseModel):
 
 
 class Device(db.Model, BaseModel):
+    __table_args__ = (db.Index("ix_device_last_four", "last_four"),)
+
     id = db.Column(db.Integer, primary_key=True)
     device_name = db.Column(db.String(80), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    device_key = db.Column(db.String(80), nullable=False)
-    last_four = db.Column(db.String(4), nullable=False)
+    device_key = db.Column(db.String(255), nullable=False)
+    last_four = db.Column(db.String(24), nullable=False)
 
     @staticmethod
     def find_by_name(user_id, device_name):
@@ -418,11 +898,57 @@ class Device(db.Model, BaseModel):
     def find_devices_for_user(cls, user_id):
         return Session.query(Device).filter_by(user_id=user_id).all()
 
+    @staticmethod
+    def mask_key(device_key: str) -> str:
+        return f"{'*'*20}{device_key[-4:]}"
+
+    def delete_from_db(self):
+        with _verified_keys_lock:
+            for key_hash, (device_id, _, _) in list(_verified_keys.items()):
+                if device_id == self.id:
+                    del _verified_keys[key_hash]
+        super().delete_from_db()
+
     @staticmethod
     def find_by_key(device_key):
-        # TODO With a ton of devices, this will not be efficient
-        devices = Session.query(Device).all()
+        """
+        The masked key's last four characters narrow the lookup down to
+        (almost always) one device, so only one slow salted hash check is
+        needed. Verified keys are cached for Config.API_KEY_CACHE_SECONDS.
+        """
+        if not device_key:
+            return None
+
+        if cached := Device._find_verified_key(device_key):
+            return Device.find_by_id(cached[0])
+
+        devices = (
+            Session.query(Device).filter_by(last_four=Device.mask_key(device_key)).all()
+        )
         for device in devices:
             if check_password_hash(device.device_key, device_key):
+                expires = time.monotonic() + Config.API_KEY_CACHE_SECONDS
+                key_hash = hashlib.sha256(device_key.encode()).hexdigest()
+                with _verified_keys_lock:
+                    _verified_keys[key_hash] = (device.id, device.user_id, expires)
                 return device
         return None
+
+    @staticmethod
+    def _find_verified_key(device_key) -> Optional[tuple[int, int, float]]:
+        key_hash = hashlib.sha256(device_key.encode()).hexdigest()
+        with _verified_keys_lock:
+            cached = _verified_keys.get(key_hash)
+        if cached and cached[2] > time.monotonic():
+            return cached
+        return None
+
+    @staticmethod
+    def find_user_id_by_key(device_key) -> Optional[int]:
+        """
+        Like find_by_key, but a recently verified key needs no query at all.
+        """
+        if device_key and (cached := Device._find_verified_key(device_key)):
+            return cached[1]
+        device = Device.find_by_key(device_key)
+        return device.user_id if device else None
@@ -12,8 +12,11 @@ from flask import (
 from flask_login import current_user, login_required, login_user, logout_user
 from werkzeug.security import check_password_hash, generate_password_hash
 import models as db
+from config import Config
 from services.time_str import get_time_from_url, get_url_without_time
-from services.markdown import generate_source_markdown
+from services.markdown import RenderedMarkdown, get_source_markdown
+from services.queue_signal import notify_queue
+from services.audible import request_user_sync
 
 main = Blueprint("main", __name__)
 api = Blueprint("api", __name__, url_prefix="/api")
@@ -39,15 +42,32 @@ def logout():
 @main.get("/")
 @login_required
 def index():
-    sources = db.Source.get_user_sources_snippets(current_user.id)
+    sources, next_cursor = db.Source.get_user_sources_snippets(
+        current_user.id, limit=Config.SOURCES_PAGE_SIZE
+    )
     queue = db.Snippet.get_user_queue(current_user.id)
     return render_template(
         "index.html",
         sources=sources,
+        next_cursor=next_cursor,
         queue=queue,
     )
 
 
+@main.get("/sources")
+@login_required
+def get_sources_page():
+    cursor = request.args.get("cursor", type=int)
+    sources, next_cursor = db.Source.get_user_sources_snippets(
+        current_user.id, cursor=cursor, limit=Config.SOURCES_PAGE_SIZE
+    )
+    return render_template(
+        "partials/source_page.html",
+        sources=sources,
+        next_cursor=next_cursor,
+    )
+
+
 @main.post("/login")
 def login_post():
     if request.form:
@@ -82,6 +102,13 @@ def post_settings():
     return ""
 
 
+@main.post("/audible/sync")
+@login_required
+def sync_audible():
+    request_user_sync(current_user.id)
+    return "Sync requested"
+
+
 @main.post("/register")
 def register_user():
     password = request.form["password"]
@@ -104,11 +131,23 @@ def register_user():
     return response
 
 
+def markdown_response(rendered: RenderedMarkdown) -> Response:
+    """
+    Answers with 304 Not Modified and no body when the client's If-None-Match
+    or If-Modified-Since shows it already has this markdown.
+    """
+    response = Response(rendered.body)
+    response.set_etag(rendered.etag)
+    response.last_modified = rendered.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 @main.get("/source/<int:source_id>/markdown")
 @login_required
-def get_source_markdown(source_id):
+def get_source_markdown_page(source_id):
     user_id = current_user.id
-    return generate_source_markdown(source_id, user_id)
+    return markdown_response(get_source_markdown(source_id, user_id))
 
 
 @main.delete("/source/<int:source_id>")
@@ -160,7 +199,7 @@ def add_device():
         device_name=name,
         user_id=current_user.id,
         device_key=device_key_hashed,
-        last_four=f"{'*'*20}{device_key[-4:]}",
+        last_four=db.Device.mask_key(device_key),
     )
     new_device.add_to_db()
     return render_template("partials/device_input.html", device_key=device_key)
@@ -195,6 +234,7 @@ def enqueue():
     user_id = current_user.id
     source = db.Source.add(source_url)
     db.Snippet.add(user_id, source.id, start_time, end_time)
+    notify_queue()
     queue = db.Snippet.get_user_queue(user_id)
     return render_template("partials/queue.html", queue=queue)
 
@@ -212,34 +252,49 @@ def get_queue_item(queue_id):
 def api_get_source_markdown(source_id):
     api_key = request.headers.get("X-Api-Key")
 
-    user_id = db.Device.find_by_key(api_key).user_id
+    # Verified keys are cached, so an unchanged poll doesn't touch the database
+    user_id = db.Device.find_user_id_by_key(api_key)
+    if user_id is None:
+        return "Invalid API key", 401
     get_latest = request.args.get("latest", default=False, type=bool)
     exclusions = request.args.get("exclude", [])
-    return generate_source_markdown(
+    rendered = get_source_markdown(
         source_id, user_id, latest=get_latest, exclusions=exclusions
     )
+    return markdown_response(rendered)
 
 
 @api.post("/source/<int:source_id>/sync")
 def api_update_sync(source_id):
     api_key = request.headers.get("X-Api-Key")
     user_id = db.Device.find_by_key(api_key).user_id
-    sync_record = db.SyncRecord.find_by_user_source(user_id, source_id)
-    if sync_record:
-        sync_record.update_sync_time()
-    else:
-        sync_record = db.SyncRecord(user_id=user_id, source_id=source_id)
-        sync_record.add_to_db()
+    sync_record = db.SyncRecord.update_user_source(user_id, source_id)
     return jsonify(sync_record)
 
 
+@api.post("/audible/sync")
+def api_sync_audible():
+    api_key = request.headers.get("X-Api-Key")
+    user_id = db.Device.find_by_key(api_key).user_id
+    request_user_sync(user_id)
+    return "Success", 200
+
+
 @api.get("/sources")
 def api_get_sources():
     # TODO Better parsing of args -- failure states
     api_key = request.headers.get("X-Api-Key")
     user_id = db.Device.find_by_key(api_key).user_id
-    sources = db.Source.get_user_sources_snippets(user_id)
-    return jsonify(sources)
+    cursor = request.args.get("cursor", type=int)
+    limit = request.args.get("limit", default=Config.SOURCES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, Config.SOURCES_MAX_PAGE_SIZE))
+    sources, next_cursor = db.Source.get_user_sources_snippets(
+        user_id, cursor=cursor, limit=limit
+    )
+    response = jsonify(sources)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return response
 
 
 @api.post("/enqueue")
@@ -253,4 +308,5 @@ def api_enqueue():
     user_id = db.Device.find_by_key(api_key).user_id
     source = db.Source.add(source_url)
     db.Snippet.add(user_id, source.id, start, end)
+    notify_queue()
     return "Success", 200
@@ -1,17 +1,18 @@
 import subprocess
 import os
-import shutil
 import time
-import requests
 import logging
 import audible
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from threading import Event, Lock, Thread
+from typing import Iterator, List, Optional
 import models as db
 from config import Config
 from string import Template
 from pathlib import Path
-from services import files
+from services import downloads, files, queue_signal
 
 DOWNLOAD_URL = Template(
     "https://www.audible.com/library/download?asin=$asin&codec=AAX",
@@ -21,6 +22,30 @@ BOOKMARK_URL = Template(
     "https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key=$asin",
 )
 
+ANNOTATION_BATCH_SIZE = 25
+# The annotation state recorded for books without a listening position
+NOT_STARTED = "not started"
+
+# Slimmed-down library listings per user, with the time they were fetched
+_library_cache: dict[int, tuple[float, List]] = {}
+_library_cache_lock = Lock()
+
+# Per-user sync schedule, guarded by _schedule_lock
+_next_sync: dict[int, float] = {}
+_sync_failures: dict[int, int] = {}
+_syncing = set()
+_sync_requested = set()
+_schedule_lock = Lock()
+_schedule_event = Event()
+
+# Authenticators per user, reloaded when their auth file changes
+_credentials: dict[int, "AudibleCredentials"] = {}
+_credentials_lock = Lock()
+
+# Store keys with a background AAX to M4B conversion in progress
+_converting = set()
+_converting_lock = Lock()
+
 
 class AudibleClip:
     asin: str
@@ -69,47 +94,146 @@ class AudibleClip:
         )
 
 
-def get_library_items(user_id: int) -> List:
-    auth = get_audible_auth(user_id)
-
-    with audible.Client(auth=auth) as client:
+def iter_library_items(client: audible.Client) -> Iterator[dict]:
+    """
+    Yields the user's library page by page, keeping only the fields that the
+    sync uses.
+    """
+    page = 1
+    while True:
         library = client.get(
             "1.0/library",
-            num_results=1000,
-            response_groups="product_desc, product_attrs, media",
+            num_results=Config.AUDIBLE_LIBRARY_PAGE_SIZE,
+            page=page,
+            response_groups="media",
             sort_by="-PurchaseDate",
         )
-    return library["items"]
-
-
-def get_new_clips(user_id: int) -> List[AudibleClip]:
-    books = get_library_items(user_id)
-    all_clips = get_all_clips(user_id, books)
+        items = library["items"]
+        for item in items:
+            yield {
+                "asin": item["asin"],
+                "title": item["title"],
+                "product_images": item.get("product_images") or {},
+            }
+        if len(items) < Config.AUDIBLE_LIBRARY_PAGE_SIZE:
+            return
+        page += 1
+
+
+def get_library_items(user_id: int, client: audible.Client) -> List:
+    with _library_cache_lock:
+        cached = _library_cache.get(user_id)
+    if cached and time.time() - cached[0] < Config.AUDIBLE_LIBRARY_REFRESH_SECONDS:
+        return cached[1]
+
+    items = list(iter_library_items(client))
+    with _library_cache_lock:
+        _library_cache[user_id] = (time.time(), items)
+    return items
+
+
+def get_new_clips(user_id: int) -> tuple[List[AudibleClip], dict, set[str]]:
+    """
+    Returns the clips made since the last sync, the new annotation states of
+    the books that were fetched and the ASINs new to the library listing.
+    Nothing is saved, so a failed ingest is retried on the next sync.
+    All clips are kept for books new to the listing. It's cached, so a new
+    book can show up syncs after its first clips were made.
+    """
+    seen_asins = db.AudibleLibraryBook.find_user_asins(user_id)
+    auth = get_audible_auth(user_id)
+    with audible.Client(auth=auth) as client:
+        books = get_library_items(user_id, client)
+        all_clips, book_states = get_all_clips(user_id, client, books)
+    new_asins = {book["asin"] for book in books} - seen_asins
 
     last_sync = db.AudibleSyncRecord.get_user_last_sync(user_id)
     if last_sync:
-        new_clips = [clip for clip in all_clips if clip.creation_time > last_sync]
+        # Users synced before listings were recorded have seen all their books
+        new_books = new_asins if seen_asins else set()
+        new_clips = [
+            clip
+            for clip in all_clips
+            if clip.asin in new_books or clip.creation_time > last_sync
+        ]
     else:
         new_clips = all_clips
 
-    db.AudibleSyncRecord.update_user_sync_record(user_id)
-    return new_clips
-
-
-def get_all_clips(user_id: int, books: List) -> List[AudibleClip]:
-    auth = get_audible_auth(user_id)
+    save_credentials(user_id)
+    return new_clips, book_states, new_asins
+
+
+def get_annotation_states(client: audible.Client, asins: List[str]) -> dict:
+    """
+    Returns when each book's listening position was last updated. Clips are
+    made while listening, so a book whose state hasn't changed since the last
+    sync has no new clips. Books that haven't been started get NOT_STARTED,
+    and books in batches that failed are left out.
+    """
+    states = {}
+    for i in range(0, len(asins), ANNOTATION_BATCH_SIZE):
+        batch = asins[i : i + ANNOTATION_BATCH_SIZE]
+        try:
+            resp = client.get(
+                "1.0/annotations/lastpositions",
+                asins=",".join(batch),
+            )
+        except Exception as err:
+            logging.info(f"FAILED to get annotation states: {err}")
+            continue
+        states.update(dict.fromkeys(batch, NOT_STARTED))
+        for annotation in resp.get("asin_last_position_heard_annots", []):
+            last_heard = annotation.get("last_position_heard", {})
+            if last_updated := last_heard.get("last_updated"):
+                states[annotation["asin"]] = last_updated
+    return states
+
+
+def get_all_clips(
+    user_id: int,
+    client: audible.Client,
+    books: List,
+) -> tuple[List[AudibleClip], dict]:
+    """
+    Fetches clips for the books that changed since the last sync, with up to
+    Config.AUDIBLE_SYNC_CONCURRENCY requests at a time. Also returns the new
+    annotation states of the books that were fetched.
+    """
+    known_states = db.AudibleBookState.find_user_states(user_id)
     bookmarks = []
-    with audible.Client(auth=auth) as client:
-        for book in books:
-            clips = get_clips_from_book(client, book)
+    fetched_states = {}
+    states = get_annotation_states(client, [book["asin"] for book in books])
+    changed_books = [
+        book
+        for book in books
+        if book["asin"] not in states
+        or states[book["asin"]] != known_states.get(book["asin"])
+    ]
+    logging.info(
+        f"{len(changed_books)} of {len(books)} Audible books changed "
+        f"for user {user_id}"
+    )
+
+    with ThreadPoolExecutor(Config.AUDIBLE_SYNC_CONCURRENCY) as executor:
+        results = executor.map(
+            lambda book: get_clips_from_book(client, book),
+            changed_books,
+        )
+        for book, clips in zip(changed_books, results):
+            if clips is None:
+                continue
             bookmarks.extend(clips)
-    return bookmarks
+            if book["asin"] in states:
+                fetched_states[book["asin"]] = states[book["asin"]]
+    return bookmarks, fetched_states
 
 
-def get_clips_from_book(client: audible.Client, book: dict) -> List[AudibleClip]:
+def get_clips_from_book(
+    client: audible.Client,
+    book: dict,
+) -> Optional[List[AudibleClip]]:
     url = BOOKMARK_URL.substitute(asin=book["asin"])
-    client._response_callback = lambda resp: resp
-    resp = client.get(url)
+    resp = client.get(url, response_callback=lambda resp: resp)
     bookmarks = []
     try:
         body = resp.json()["payload"]
@@ -122,64 +246,52 @@ def get_clips_from_book(client: audible.Client, book: dict) -> List[AudibleClip]
     except KeyError:
         msg = f"{book['title']} FAILED to get bookmarks: {resp.status_code}"
         logging.info(msg)
+        return None
     return bookmarks
 
 
-def find_book_file(asin: str) -> Optional[str]:
-    audible_directory = files.get_audible_dir()
-    for file in os.listdir(audible_directory):
-        if not os.path.isfile(os.path.join(audible_directory, file)):
-            continue
-        elif asin in file:
-            return os.path.join(audible_directory, file)
-    return None
-
-
-def download_book(client, asin) -> str:
-    if book_file := find_book_file(asin):
-        logging.info(f"Book {asin} already downloaded")
-        return book_file
-
+def download_book(client, asin, directory) -> str:
     logging.info(f"Downloading book for asin {asin}")
     client._response_callback = lambda resp: resp.next_request
     url = DOWNLOAD_URL.substitute(asin=asin.zfill(10))
     resp = client.get(url)
-    book_file = os.path.join(files.get_audible_dir(), f"{asin}.aax")
-    with requests.get(resp.url, stream=True) as r:
-        if not r.ok:
-            msg = "Failed to download Audible book"
-            raise ConnectionError(msg, r)
-        with open(book_file, "wb") as f:
-            shutil.copyfileobj(r.raw, f)
+    book_file = os.path.join(directory, f"{asin}.aax")
+    downloads.download(resp.url, book_file)
 
     logging.info(f"Downloaded {book_file}")
     return book_file
 
 
-def create_models(user_id: int, audible_clip: AudibleClip):
-    book_file = f"file://{audible_clip.asin}.aax"
-    source = db.Source.add(
-        url=book_file,
-        title=audible_clip.title,
-        provider=db.SourceProvider.AUDIBLE,
-        thumb_url=audible_clip.thumbnail,
-    )
-    snippet = db.Snippet.add(
-        user_id,
-        source.id,
-        audible_clip.start_seconds,
-        audible_clip.end_seconds,
-    )
-    db.Audible.add(
-        snippet.id,
-        audible_clip.asin,
-    )
-
-
-def aax_to_m4b(aax_path: str, activation_bytes: str) -> Optional[str]:
+def ingest_clips(user_id: int, audible_clips: List[AudibleClip]) -> int:
+    """
+    Adds the clips in batches of Config.AUDIBLE_INGEST_BATCH_SIZE, one
+    transaction per batch, so a large backfill doesn't hold the write lock
+    for its whole duration.
+    """
+    num_added = 0
+    batch_size = Config.AUDIBLE_INGEST_BATCH_SIZE
+    for i in range(0, len(audible_clips), batch_size):
+        clips = [
+            {
+                "url": f"file://{audible_clip.asin}.aax",
+                "title": audible_clip.title,
+                "thumb_url": audible_clip.thumbnail,
+                "asin": audible_clip.asin,
+                "start_time": audible_clip.start_seconds,
+                "end_time": audible_clip.end_seconds,
+            }
+            for audible_clip in audible_clips[i : i + batch_size]
+        ]
+        num_added += db.Audible.bulk_add(user_id, clips)
+    if num_added:
+        queue_signal.notify_queue()
+    return num_added
+
+
+def aax_to_m4b(aax_path: str, activation_bytes: str, directory: str) -> Optional[str]:
     logging.info(f"Converting {aax_path} to m4b")
     path = Path(aax_path)
-    m4b_path = os.path.join(path.parents[0], f"{path.stem}.m4b")
+    m4b_path = os.path.join(directory, f"{path.stem}.m4b")
     try:
         ffmpeg_proc = subprocess.run(
             [
@@ -199,38 +311,154 @@ def aax_to_m4b(aax_path: str, activation_bytes: str) -> Optional[str]:
         logging.error(msg)
         return None
 
-    if ffmpeg_proc.returncode == 0:
-        os.remove(aax_path)
-
     return m4b_path
 
 
-def download_audible_data(queue_item: db.Snippet) -> Optional[str]:
+def get_store_key(user_id: int, asin: str) -> str:
+    return f"{user_id}-{asin}"
+
+
+def convert_book(store_key: str, activation_bytes: str):
+    """
+    Replaces the stored AAX under store_key with a decrypted M4B.
+    """
+    aax_path = files.audible_store.acquire(store_key)
+    if not aax_path:
+        return
+    job_dir = files.make_job_dir()
+    try:
+        if aax_path.endswith("aax"):
+            if m4b_path := aax_to_m4b(aax_path, activation_bytes, job_dir):
+                files.audible_store.put(store_key, m4b_path)
+    finally:
+        files.audible_store.release(store_key)
+        files.cleanup_tmp_files(job_dir)
+        with _converting_lock:
+            _converting.discard(store_key)
+
+
+def convert_book_in_background(store_key: str, activation_bytes: str):
+    with _converting_lock:
+        if store_key in _converting:
+            return
+        _converting.add(store_key)
+    convert_thread = Thread(target=convert_book, args=(store_key, activation_bytes))
+    convert_thread.daemon = True
+    convert_thread.start()
+
+
+def download_audible_data(queue_item: db.Snippet, directory: str) -> Optional[str]:
+    """
+    Downloads the encrypted AAX book. Clips are decrypted straight from it
+    with the user's activation bytes, so no full conversion is needed first.
+    """
     auth = get_audible_auth(queue_item.user_id)
+    audible_data = db.Audible.get_audible_data(queue_item.id)
     with audible.Client(auth=auth) as client:
-        audible_data = db.Audible.get_audible_data(queue_item.id)
-        book_file = download_book(client, audible_data.asin)
-    if book_file.endswith("aax"):
-        activation_bytes = get_activation_bytes(queue_item.user_id)
-        book_file = aax_to_m4b(book_file, activation_bytes)
+        book_file = download_book(client, audible_data.asin, directory)
+    save_credentials(queue_item.user_id)
     return book_file
 
 
+def sync_user(user_id: int):
+    logging.info(f"Syncing with Audible for user {user_id}")
+    if not user_has_audible_auth(user_id):
+        logging.info(f"No audible_auth for user {user_id}")
+        return
+    clips, book_states, new_asins = get_new_clips(user_id)
+    logging.info(f"Found {len(clips)} new Audible clips for user {user_id}")
+    num_added = ingest_clips(user_id, clips)
+    logging.info(f"Added {num_added} Audible snippets for user {user_id}")
+    db.AudibleLibraryBook.add_user_asins(user_id, new_asins)
+    db.AudibleBookState.update_user_states(user_id, book_states)
+    db.AudibleSyncRecord.update_user_sync_record(user_id)
+
+
+def run_user_sync(user_id: int):
+    failed = False
+    try:
+        sync_user(user_id)
+    except Exception:
+        logging.exception(f"Audible sync failed for user {user_id}")
+        db.Session.rollback()
+        failed = True
+    finally:
+        db.Session.remove()
+
+    with _schedule_lock:
+        if failed:
+            failures = _sync_failures.get(user_id, 0) + 1
+            _sync_failures[user_id] = failures
+            delay = min(
+                Config.AUDIBLE_SYNC_SECONDS * 2**failures,
+                Config.AUDIBLE_SYNC_MAX_BACKOFF_SECONDS,
+            )
+        else:
+            _sync_failures.pop(user_id, None)
+            delay = Config.AUDIBLE_SYNC_SECONDS
+        _syncing.discard(user_id)
+        _next_sync[user_id] = max(_next_sync.get(user_id, 0), time.time() + delay)
+        if user_id in _sync_requested:
+            _sync_requested.discard(user_id)
+            _next_sync[user_id] = 0
+    _schedule_event.set()
+
+
+def request_user_sync(user_id: int):
+    with _schedule_lock:
+        if user_id in _syncing:
+            _sync_requested.add(user_id)
+        else:
+            _next_sync[user_id] = 0
+    _schedule_event.set()
+
+
+def schedule_syncs(executor: ThreadPoolExecutor) -> float:
+    """
+    Submits the syncs that are due and returns how long to wait for the next.
+    """
+    now = time.time()
+    user_ids = [user.id for user in db.User.get_all()]
+    db.Session.remove()
+    with _schedule_lock:
+        for user_id in user_ids:
+            _next_sync.setdefault(user_id, now)
+        due = [
+            user_id
+            for user_id, next_sync in _next_sync.items()
+            if next_sync <= now and user_id not in _syncing
+        ]
+        _syncing.update(due)
+        waiting = [
+            next_sync
+            for user_id, next_sync in _next_sync.items()
+            if user_id not in _syncing
+        ]
+    for user_id in due:
+        executor.submit(run_user_sync, user_id)
+
+    timeout = min(waiting, default=now + Config.AUDIBLE_SYNC_SECONDS) - now
+    # New users are picked up on the next tick
+    return min(timeout, Config.AUDIBLE_SCHEDULER_TICK_SECONDS)
+
+
 def sync_with_audible():
-    while True:
-        for user in db.User.get_all():
-            logging.info(f"Syncing with Audible for user {user.id}")
-            if not user_has_audible_auth(user.id):
-                logging.info(f"No audible_auth for user {user.id}")
-                continue
-            clips = get_new_clips(user.id)
-            logging.info(f"Found {len(clips)} new Audible clips for user {user.id}")
-            for clip in clips:
-                create_models(
-                    user.id,
-                    clip,
-                )
-        time.sleep(Config.AUDIBLE_SYNC_SECONDS)
+    """
+    Gives every user their own next sync time and runs due syncs on a pool of
+    Config.AUDIBLE_SYNC_USERS threads, so one slow or failing account doesn't
+    hold up the others. Failing accounts back off exponentially.
+    """
+    with ThreadPoolExecutor(Config.AUDIBLE_SYNC_USERS) as executor:
+        while True:
+            try:
+                timeout = schedule_syncs(executor)
+            except Exception:
+                # e.g. the database being locked; retried on the next tick
+                logging.exception("Scheduling Audible syncs failed")
+                db.Session.remove()
+                timeout = Config.AUDIBLE_SCHEDULER_TICK_SECONDS
+            _schedule_event.wait(timeout)
+            _schedule_event.clear()
 
 
 def print_captcha_url(url: str):
@@ -261,22 +489,73 @@ def save_audible_auth_to_file(email: str, password: str):
     return auth
 
 
-def user_has_audible_auth(user_id: int) -> bool:
-    auth_file = os.path.join(
+@dataclass
+class AudibleCredentials:
+    auth: audible.Authenticator
+    mtime: float
+    saved_state: tuple
+
+
+def get_auth_file(user_id: int) -> str:
+    return os.path.join(
         files.get_audible_dir(),
         str(user_id),
         "audible_auth.json",
     )
-    return os.path.exists(auth_file)
+
+
+def get_auth_state(auth: audible.Authenticator) -> tuple:
+    return auth.access_token, auth.activation_bytes
+
+
+def get_credentials(user_id: int) -> Optional[AudibleCredentials]:
+    """
+    Returns the user's cached Authenticator, reloading it only when the auth
+    file has changed on disk.
+    """
+    auth_file = get_auth_file(user_id)
+    try:
+        mtime = os.path.getmtime(auth_file)
+    except OSError:
+        with _credentials_lock:
+            _credentials.pop(user_id, None)
+        return None
+
+    with _credentials_lock:
+        credentials = _credentials.get(user_id)
+        if not credentials or credentials.mtime != mtime:
+            auth = audible.Authenticator.from_file(auth_file)
+            credentials = AudibleCredentials(auth, mtime, get_auth_state(auth))
+            _credentials[user_id] = credentials
+        return credentials
+
+
+def save_credentials(user_id: int):
+    """
+    Writes refreshed tokens and fetched activation bytes back to the auth
+    file, once per change.
+    """
+    with _credentials_lock:
+        credentials = _credentials.get(user_id)
+        if not credentials:
+            return
+        state = get_auth_state(credentials.auth)
+        if state == credentials.saved_state:
+            return
+        auth_file = get_auth_file(user_id)
+        credentials.auth.to_file(auth_file)
+        credentials.mtime = os.path.getmtime(auth_file)
+        credentials.saved_state = state
+
+
+def user_has_audible_auth(user_id: int) -> bool:
+    return get_credentials(user_id) is not None
 
 
 def get_audible_auth(user_id: int) -> Optional[audible.Authenticator]:
-    auth_file = os.path.join(
-        files.get_audible_dir(),
-        str(user_id),
-        "audible_auth.json",
-    )
-    return audible.Authenticator.from_file(auth_file)
+    if credentials := get_credentials(user_id):
+        return credentials.auth
+    return None
 
 
 def get_activation_bytes(user_id: int) -> str:
@@ -286,4 +565,6 @@ def get_activation_bytes(user_id: int) -> str:
         "activation_bytes",
     )
     auth = get_audible_auth(user_id)
-    return auth.get_activation_bytes(activation_file, True)
+    activation_bytes = auth.get_activation_bytes(activation_file, True)
+    save_credentials(user_id)
+    return activation_bytes
@@ -0,0 +1,130 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import Config
+
+CHUNK_SIZE = 1024 * 1024
+
+# A single pooled session shared by every download so connections to the same
+# hosts are reused across jobs.
+session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=Config.DOWNLOAD_POOL_SIZE,
+    pool_maxsize=Config.DOWNLOAD_POOL_SIZE,
+    max_retries=Retry(
+        total=Config.DOWNLOAD_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "HEAD"],
+    ),
+)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def get(url, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", Config.DOWNLOAD_TIMEOUT)
+    return session.get(url, **kwargs)
+
+
+def get_ranged_size(url) -> Optional[int]:
+    """
+    Returns the size of the file if the server accepts byte ranges for it.
+    """
+    r = session.head(url, allow_redirects=True, timeout=Config.DOWNLOAD_TIMEOUT)
+    if not r.ok or r.headers.get("Accept-Ranges") != "bytes":
+        return None
+    try:
+        return int(r.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def stream_to_file(url, f, start=0, end=None, file_offset=None):
+    """
+    Streams bytes start to end (inclusive) of url into f, starting at
+    file_offset in f, which defaults to start so segments of one download
+    land in place. A dropped connection is resumed with a Range request from
+    the last byte written, up to Config.DOWNLOAD_RETRIES times.
+    """
+    if file_offset is None:
+        file_offset = start
+    position = start
+    retries = 0
+    while True:
+        headers = {}
+        if position > 0 or end is not None:
+            range_end = "" if end is None else end
+            headers["Range"] = f"bytes={position}-{range_end}"
+        try:
+            with get(url, headers=headers, stream=True) as r:
+                r.raise_for_status()
+                if headers and r.status_code != 206:
+                    raise RangeNotSupported(url)
+                f.seek(file_offset + position - start)
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    position += len(chunk)
+            return
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as err:
+            retries += 1
+            if retries > Config.DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f"Resuming download of {url} at byte {position}: {err}")
+
+
+def download_segmented(url, filepath, size):
+    segment_size = -(-size // Config.DOWNLOAD_SEGMENTS)
+    with open(filepath, "wb") as f:
+        f.truncate(size)
+
+    def download_segment(start):
+        end = min(start + segment_size, size) - 1
+        with open(filepath, "r+b") as f:
+            stream_to_file(url, f, start, end)
+
+    with ThreadPoolExecutor(Config.DOWNLOAD_SEGMENTS) as executor:
+        list(executor.map(download_segment, range(0, size, segment_size)))
+
+
+def download(url, filepath) -> str:
+    """
+    Streams url to filepath. Large files on servers that accept byte ranges
+    are fetched as Config.DOWNLOAD_SEGMENTS parallel segments.
+    """
+    size = None
+    if Config.DOWNLOAD_SEGMENTS > 1:
+        size = get_ranged_size(url)
+    if size and size >= Config.SEGMENTED_DOWNLOAD_MIN_SIZE:
+        logging.info(f"Downloading {url} in {Config.DOWNLOAD_SEGMENTS} segments")
+        download_segmented(url, filepath, size)
+    else:
+        with open(filepath, "wb") as f:
+            stream_to_file(url, f)
+    return filepath
+
+
+def download_range(url, filepath, start, end) -> bool:
+    """
+    Streams bytes start to end (inclusive) of url to the start of filepath.
+    Returns False if the server doesn't support byte ranges.
+    """
+    try:
+        with open(filepath, "wb") as f:
+            stream_to_file(url, f, start, end, file_offset=0)
+    except RangeNotSupported:
+        return False
+    return True
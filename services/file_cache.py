@@ -0,0 +1,155 @@
+import logging
+import os
+import shutil
+import time
+from collections import Counter, OrderedDict, defaultdict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Optional
+
+
+@dataclass
+class CacheEntry:
+    path: str
+    size: int
+    last_access: float
+
+
+class FileCache:
+    """
+    A directory of files keyed by name and bounded by total size.
+    Least-recently-used files are evicted once max_size is exceeded, except
+    for files that are pinned by a job that is still using them. Access
+    order survives restarts through the files' modification times.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._pins: Counter[str] = Counter()
+        self._replaced: defaultdict[str, list[str]] = defaultdict(list)
+        self._key_locks = defaultdict(Lock)
+        self._lock = Lock()
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for file in os.listdir(self.directory):
+            path = os.path.join(self.directory, file)
+            if not os.path.isfile(path):
+                continue
+            key = os.path.splitext(file)[0]
+            stat = os.stat(path)
+            entry = CacheEntry(path, stat.st_size, stat.st_mtime)
+            entries.append((stat.st_mtime, key, entry))
+        for _, key, entry in sorted(entries, key=lambda e: e[0]):
+            # Only the newest file for a key is kept, e.g. after a conversion
+            if key in self._entries:
+                os.remove(self._entries[key].path)
+            self._entries[key] = entry
+        self._loaded = True
+
+    @property
+    def size(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def _key_lock(self, key: str) -> Lock:
+        with self._lock:
+            return self._key_locks[key]
+
+    def _touch(self, key: str):
+        self._entries.move_to_end(key)
+        entry = self._entries[key]
+        entry.last_access = time.time()
+        os.utime(entry.path, (entry.last_access, entry.last_access))
+
+    def _evict(self):
+        total_size = self.size
+        for key in list(self._entries):
+            if total_size <= self.max_size:
+                break
+            # Pinned files are in use, so the cache can briefly exceed max_size
+            if self._pins[key]:
+                continue
+            entry = self._entries.pop(key)
+            total_size -= entry.size
+            os.remove(entry.path)
+            logging.info(f"Evicted {entry.path} from cache")
+
+    def _get(self, key: str) -> Optional[str]:
+        self._load()
+        if key not in self._entries or not os.path.exists(self._entries[key].path):
+            self._entries.pop(key, None)
+            return None
+        self._touch(key)
+        return self._entries[key].path
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get(key)
+
+    def _remove_replaced(self, key: str):
+        if self._pins[key]:
+            return
+        for path in self._replaced.pop(key, []):
+            os.remove(path)
+
+    def put(self, key: str, filepath: str, pin: bool = False) -> str:
+        """
+        Moves filepath into the cache under key, pinning it first if pin is
+        set so it can't be evicted to make room for itself. A previous file
+        for key with a different extension is deleted once no job has it
+        pinned.
+        """
+        extension = os.path.splitext(filepath)[1]
+        path = os.path.join(self.directory, f"{key}{extension}")
+        with self._lock:
+            self._load()
+            if key in self._entries and self._entries[key].path != path:
+                self._replaced[key].append(self._entries[key].path)
+            shutil.move(filepath, path)
+            self._entries[key] = CacheEntry(path, os.path.getsize(path), time.time())
+            self._touch(key)
+            if pin:
+                self._pins[key] += 1
+            self._remove_replaced(key)
+            self._evict()
+        return path
+
+    def acquire(
+        self,
+        key: str,
+        fetch: Optional[Callable[[], Optional[str]]] = None,
+    ) -> Optional[str]:
+        """
+        Returns the cached file for key, calling fetch to produce it on a miss.
+        The file is pinned against eviction until release is called.
+        """
+        with self._key_lock(key):
+            with self._lock:
+                if path := self._get(key):
+                    self.hits += 1
+                    self._pins[key] += 1
+                else:
+                    self.misses += 1
+            if not path:
+                fetched_path = fetch() if fetch else None
+                if not fetched_path:
+                    return None
+                path = self.put(key, fetched_path, pin=True)
+        logging.info(f"Cache hits: {self.hits}, misses: {self.misses}")
+        return path
+
+    def release(self, key: str):
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+            self._remove_replaced(key)
+            self._evict()
@@ -1,12 +1,24 @@
+import json
+import logging
 import os
 import pathlib
+import shutil
 import subprocess
+import tempfile
+from typing import Optional
 from urllib.parse import urlparse
 
-import requests
-from pydub import AudioSegment
-
 from config import Config
+from services import downloads
+from services.file_cache import FileCache
+
+audio_cache = FileCache(
+    os.path.join(Config.TMP_DIRECTORY, "sources"),
+    Config.TMP_MAX_SIZE,
+)
+# Audible books (AAX, or M4B once converted), keyed by user and ASIN since AAX
+# files are encrypted for the account that downloaded them
+audible_store = FileCache(Config.AUDIBLE_DIRECTORY, Config.AUDIBLE_MAX_SIZE)
 
 
 def get_tmp_dir():
@@ -14,6 +26,10 @@ def get_tmp_dir():
     return Config.TMP_DIRECTORY
 
 
+def make_job_dir() -> str:
+    return tempfile.mkdtemp(dir=get_tmp_dir())
+
+
 def get_audible_dir():
     os.makedirs(Config.AUDIBLE_DIRECTORY, exist_ok=True)
     return Config.AUDIBLE_DIRECTORY
@@ -25,9 +41,8 @@ def get_audible_user_dir(user_id: int) -> str:
     return path
 
 
-def download_file(url, filename=None):
-    directory = get_tmp_dir()
-    r = requests.get(url)
+def get_download_path(url, filename=None, directory=None):
+    directory = directory or get_tmp_dir()
     parsed_url = urlparse(url)
 
     if not filename:
@@ -35,44 +50,129 @@ def download_file(url, filename=None):
     else:
         filename = filename + "." + parsed_url.path.split(".")[-1]
 
-    filepath = os.path.join(directory, filename)
-    with open(filepath, "wb") as f:
-        f.write(r.content)
-    return filepath
-
-
-def clip_m4b_to_wav(filepath, start_time, end_time):
-    start_seconds = str(start_time)
-    duration_seconds = str(end_time - start_time)
+    return os.path.join(directory, filename)
+
+
+def download_file(url, filename=None, directory=None):
+    filepath = get_download_path(url, filename, directory)
+    return downloads.download(url, filepath)
+
+
+def probe_audio(url) -> Optional[tuple[float, int, str]]:
+    """
+    Returns the duration in seconds, the size in bytes and the format name of
+    remote audio. ffprobe only needs the first few kilobytes of the file to
+    estimate these. Returns None if the host doesn't answer within
+    Config.DOWNLOAD_TIMEOUT, so the whole file is downloaded instead.
+    """
+    try:
+        ffprobe_proc = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-rw_timeout",
+                str(Config.DOWNLOAD_TIMEOUT * 1_000_000),
+                "-show_entries",
+                "format=duration,size,format_name",
+                "-of",
+                "json",
+                url,
+            ],
+            capture_output=True,
+            text=True,
+            timeout=Config.DOWNLOAD_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        logging.warning(f"Timed out probing {url}")
+        return None
+    try:
+        audio_format = json.loads(ffprobe_proc.stdout)["format"]
+        return (
+            float(audio_format["duration"]),
+            int(audio_format["size"]),
+            audio_format["format_name"],
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def get_id3_tag_size(url) -> int:
+    """
+    Returns the size of the ID3v2 tag at the start of an MP3, which holds
+    metadata and cover art rather than audio.
+    """
+    with downloads.get(url, headers={"Range": "bytes=0-9"}, stream=True) as r:
+        header = r.raw.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    # The tag size is stored as four 7-bit bytes and excludes the header
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer_size = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer_size
+
+
+def download_file_section(
+    url, start_time, end_time, directory=None
+) -> Optional[tuple[str, float]]:
+    """
+    Downloads roughly start_time to end_time seconds of an MP3 with an HTTP
+    Range request, estimating byte offsets from the average bitrate.
+    Returns the filepath and the time (in seconds) that the file starts at,
+    or None if the whole file should be downloaded instead: the server doesn't
+    support ranges, the file is short, or it isn't an MP3. Other formats such
+    as M4A can't be decoded from a slice without the index stored elsewhere
+    in the file.
+    """
+    probe = probe_audio(url)
+    if not probe:
+        return None
+    duration, size, format_name = probe
+    if format_name != "mp3" or duration <= Config.PARTIAL_DOWNLOAD_MIN_DURATION:
+        return None
+
+    tag_size = get_id3_tag_size(url)
+    bytes_per_second = (size - tag_size) / duration
+    start_byte = tag_size + int(start_time * bytes_per_second)
+    end_byte = min(size - 1, tag_size + int(end_time * bytes_per_second))
+    filepath = get_download_path(url, directory=directory)
+    if not downloads.download_range(url, filepath, start_byte, end_byte):
+        logging.info(f"Partial download unavailable for {url}")
+        return None
+    return filepath, (start_byte - tag_size) / bytes_per_second
+
+
+def clip_to_wavs(filepath, clips, directory=None, input_args=()):
+    """
+    Cuts every (start, end) clip out of the file with a single ffmpeg
+    invocation. Each clip is its own input seeked to its start time, so only
+    the clipped ranges are decoded and memory use doesn't grow with the
+    length of the source. input_args are passed to ffmpeg before each input,
+    e.g. the activation bytes needed to decrypt an AAX file.
+    """
+    directory = directory or get_tmp_dir()
     path = pathlib.Path(filepath)
-    clip_path = f"{get_tmp_dir()}/{path.stem}_clip.wav"
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-y",
-            "-ss",
-            start_seconds,
-            "-t",
-            duration_seconds,
-            "-i",
-            filepath,
-            clip_path,
-        ]
+    inputs = []
+    outputs = []
+    clip_paths = []
+    for i, (start_time, end_time) in enumerate(clips):
+        clip_path = f"{directory}/{path.stem}_clip{i}.wav"
+        inputs += ["-ss", str(start_time), "-t", str(end_time - start_time)]
+        inputs += [*input_args, "-i", filepath]
+        # Whisper works on 16kHz mono audio
+        outputs += ["-map", f"{i}:a", "-ac", "1", "-ar", "16000", clip_path]
+        clip_paths.append(clip_path)
+    ffmpeg_proc = subprocess.run(
+        ["ffmpeg", "-y", *inputs, *outputs],
+        capture_output=True,
+        text=True,
     )
-    return clip_path
-
-
-def clip_mp3_to_wav(filepath, start_time, end_time):
-    podcast = AudioSegment.from_mp3(filepath)
-    start_ms = start_time * 1000
-    end_ms = end_time * 1000
-    clip = podcast[start_ms:end_ms]
-    clip_path = os.path.splitext(filepath)[0] + "_clip.wav"
-    clip.export(clip_path, format="wav")
-    return clip_path
+    if ffmpeg_proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to clip {filepath}: {ffmpeg_proc.stderr}")
+    return clip_paths
 
 
-def cleanup_tmp_files():
-    tmp_directory = get_tmp_dir()
-    for f in os.listdir(tmp_directory):
-        os.remove(os.path.join(tmp_directory, f))
+def cleanup_tmp_files(directory):
+    shutil.rmtree(directory, ignore_errors=True)
@@ -1,6 +1,35 @@
-from datetime import datetime
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from itertools import chain
+from threading import Lock
+
+from sqlalchemy import event
 
 import models as db
+from config import Config
+
+# Stands in for the changed source ids when a bulk statement could have
+# changed any source's markdown
+ALL_SOURCES = "all"
+
+
+@dataclass
+class RenderedMarkdown:
+    body: str
+    etag: str
+    last_modified: datetime
+    expires: float
+
+
+# (source id, user id, exclusions, latest) -> rendered markdown, least
+# recently used first
+_cache: OrderedDict[tuple, RenderedMarkdown] = OrderedDict()
+_cache_lock = Lock()
+# Bumped on every invalidation so a render that raced one isn't cached
+_generation = 0
 
 
 def generate_source_markdown(source_id, user_id, exclusions=[], latest=False):
@@ -12,15 +41,105 @@ def generate_source_markdown(source_id, user_id, exclusions=[], latest=False):
     source = db.Source.find_by_id(source_id)
     snippets = db.Snippet.get_snippets_since(source_id, since)
 
-    markdown = ""
+    parts = []
     if "title" not in exclusions:
-        markdown = f"# {source.title}\n\n"
-        markdown += f"[{source.title}]({source.url})\n\n"
+        parts.append(f"# {source.title}\n\n")
+        parts.append(f"[{source.title}]({source.url})\n\n")
     if "thumbnail" not in exclusions:
-        markdown += f"![thumbnail]({source.thumb_url})\n\n"
+        parts.append(f"![thumbnail]({source.thumb_url})\n\n")
     for snippet in snippets:
         text = snippet.text.lstrip()
         start = snippet.start_time
-        markdown += f"{text} [{start}]({source.url}?t={start})\n\n"
+        parts.append(f"{text} [{start}]({source.url}?t={start})\n\n")
+
+    return "".join(parts)
+
+
+def get_source_markdown(
+    source_id, user_id, exclusions=[], latest=False
+) -> RenderedMarkdown:
+    """
+    Returns the markdown for the source from the cache, rendering it on a
+    miss. Entries are dropped when the source, its snippets or the user's sync
+    record change through this process's session. They also expire after
+    Config.MARKDOWN_CACHE_SECONDS, for changes made by other nodes.
+    """
+    if not isinstance(exclusions, str):
+        exclusions = tuple(sorted(exclusions))
+    key = (source_id, user_id, exclusions, bool(latest))
+    with _cache_lock:
+        rendered = _cache.get(key)
+        if rendered and rendered.expires > time.monotonic():
+            _cache.move_to_end(key)
+            return rendered
+        generation = _generation
+
+    body = generate_source_markdown(source_id, user_id, exclusions, latest)
+    rendered = RenderedMarkdown(
+        body,
+        etag=hashlib.sha256(body.encode()).hexdigest(),
+        last_modified=datetime.now(timezone.utc),
+        expires=time.monotonic() + Config.MARKDOWN_CACHE_SECONDS,
+    )
+    with _cache_lock:
+        if generation == _generation:
+            _cache[key] = rendered
+            _cache.move_to_end(key)
+            while len(_cache) > Config.MARKDOWN_CACHE_SIZE:
+                _cache.popitem(last=False)
+    return rendered
+
+
+def invalidate(source_ids):
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        if source_ids == ALL_SOURCES:
+            _cache.clear()
+            return
+        for key in list(_cache):
+            if key[0] in source_ids:
+                del _cache[key]
+
+
+@event.listens_for(db.Session, "after_flush")
+def _collect_flushed_sources(session, flush_context):
+    changed = session.info.setdefault("markdown_sources", set())
+    if changed == ALL_SOURCES:
+        return
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (db.Snippet, db.SyncRecord)):
+            changed.add(obj.source_id)
+        elif isinstance(obj, db.Source):
+            changed.add(obj.id)
+
+
+@event.listens_for(db.Session, "do_orm_execute")
+def _collect_bulk_sources(orm_execute_state):
+    """
+    Drops every source for bulk statements that don't record the sources they
+    change themselves.
+    """
+    if orm_execute_state.is_select:
+        return
+    if orm_execute_state.execution_options.get(db.RECORDS_SOURCES):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper and mapper.class_ in (db.Snippet, db.Source, db.SyncRecord):
+        orm_execute_state.session.info["markdown_sources"] = ALL_SOURCES
+
+
+@event.listens_for(db.Session, "after_commit")
+def _invalidate_committed_sources(session):
+    changed = session.info.pop("markdown_sources", set())
+    recorded = session.info.pop(db.CHANGED_SOURCES, set())
+    if changed == ALL_SOURCES:
+        invalidate(ALL_SOURCES)
+    elif changed or recorded:
+        invalidate(changed | recorded)
+
 
-    return markdown
+@event.listens_for(db.Session, "after_rollback")
+def _discard_rolled_back_sources(session):
+    session.info.pop("markdown_sources", None)
+    session.info.pop(db.CHANGED_SOURCES, None)
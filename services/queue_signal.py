@@ -0,0 +1,16 @@
+from threading import Event
+
+_queue_event = Event()
+
+
+def notify_queue():
+    _queue_event.set()
+
+
+def wait_for_queue(timeout: float):
+    """
+    Blocks until notify_queue is called or the timeout expires.
+    The timeout is a fallback for work queued by another process.
+    """
+    _queue_event.wait(timeout)
+    _queue_event.clear()
@@ -1,18 +1,18 @@
 import uuid
-import time
 import logging
+from dataclasses import dataclass, field
+from queue import Queue
+from threading import Lock, Thread
 from typing import Optional
 from urllib.parse import urlparse
 
 import yt_dlp
-import requests
-import speech_recognition as sr
 from bs4 import BeautifulSoup
 
 import models as db
-from services import files, audible
-
-r = sr.Recognizer()
+from config import Config
+from services import audible, downloads, files, queue_signal, transcription
+from services.file_cache import FileCache
 
 
 def is_source_supported(source_url):
@@ -25,64 +25,252 @@ def is_source_supported(source_url):
         return False
 
 
-# TODO: Consider switching to just using whisper instead of speech_recognition
-def whisper_recognize(clip):
-    with sr.AudioFile(clip) as source:
-        audio = r.record(source)
-        text_whisper = r.recognize_whisper(audio)
-    return text_whisper
+def clip_audio(
+    snippets: list[db.Snippet],
+    audio_filepath: str,
+    job_dir: str,
+    audio_offset: float = 0,
+    input_args: tuple[str, ...] = (),
+) -> dict[int, str]:
+    # Partial downloads start at audio_offset rather than at the beginning
+    clips = [
+        (
+            max(0, snippet.start_time - audio_offset),
+            max(0, snippet.end_time - audio_offset),
+        )
+        for snippet in snippets
+    ]
+    clip_paths = files.clip_to_wavs(audio_filepath, clips, job_dir, input_args)
+    return {snippet.id: path for snippet, path in zip(snippets, clip_paths)}
 
 
-def clip_audio(source: db.Source, queue_item: db.Snippet, audio_filepath: str):
-    start_time = queue_item.start_time
-    end_time = queue_item.end_time
+@dataclass
+class SourceJob:
+    source_id: int
+    snippet_ids: list[int]
+    job_dir: str
+    audio_filepath: Optional[str] = None
+    clip_paths: dict[int, str] = field(default_factory=dict)
+    cache: Optional[FileCache] = None
+    cache_key: Optional[str] = None
+    audio_offset: float = 0
+    partial: bool = False
+    input_args: tuple[str, ...] = ()
 
-    # TODO This should be based on file type not on source
-    if source.provider == db.SourceProvider.AUDIBLE:
-        clip_path = files.clip_m4b_to_wav(audio_filepath, start_time, end_time)
-    else:
-        clip_path = files.clip_mp3_to_wav(audio_filepath, start_time, end_time)
 
-    return clip_path
+# Sources that have had a section downloaded since startup
+_sections_fetched: set[int] = set()
+_sections_fetched_lock = Lock()
 
+clip_queue: Queue[SourceJob] = Queue(maxsize=Config.STAGE_QUEUE_SIZE)
+transcribe_queue: Queue[SourceJob] = Queue(maxsize=Config.STAGE_QUEUE_SIZE)
 
-def process_snippet_task(queue_item: db.Snippet):
-    queue_item.update_status(db.SnippetStatus.PROCESSING)
 
-    # TODO Handle illegal queued urls
-    source = db.Source.find_by_id(queue_item.source_id)
+def release_source_audio(job: SourceJob):
+    if job.cache:
+        job.cache.release(job.cache_key)
+        job.cache = None
+
+
+def mark_failed(snippet_ids: list[int]):
+    """
+    Sets the snippets to ERROR. Database errors are logged rather than raised,
+    so a dropped connection can't end the stage thread that called this.
+    """
+    try:
+        db.Session.rollback()
+        db.Snippet.set_status(snippet_ids, db.SnippetStatus.ERROR)
+    except Exception:
+        logging.exception(f"Couldn't mark snippets {snippet_ids} as failed.")
+        db.Session.remove()
+
+
+def fail_job(job: SourceJob):
+    logging.exception(f"Queue job for source {job.source_id} failed.")
+    mark_failed(job.snippet_ids)
+    release_source_audio(job)
+    files.cleanup_tmp_files(job.job_dir)
+
+
+def get_clip_section(snippets: list[db.Snippet]) -> tuple[int, int]:
+    margin = Config.PARTIAL_DOWNLOAD_MARGIN
+    start_time = min(snippet.start_time for snippet in snippets)
+    end_time = max(snippet.end_time for snippet in snippets)
+    return max(0, start_time - margin), end_time + margin
+
+
+def should_fetch_section(source_id: int) -> bool:
+    """
+    Only the first fetch of a source is partial. A source that is clipped
+    again is downloaded whole so the audio cache can serve it from then on.
+    """
+    if not Config.PARTIAL_DOWNLOADS:
+        return False
+    with _sections_fetched_lock:
+        if source_id in _sections_fetched:
+            return False
+        _sections_fetched.add(source_id)
+        return True
+
+
+def fetch_source_audio(
+    source: db.Source,
+    queue_item: db.Snippet,
+    job: SourceJob,
+    section: Optional[tuple[int, int]] = None,
+) -> Optional[str]:
     if source.provider == db.SourceProvider.YOUTUBE:
-        queue_item.update_status(db.SnippetStatus.DOWNLOADING)
-        yt_info = download_youtube_data(queue_item)
-        audio_filepath = yt_info["audio_filepath"]
-        source.update_title(yt_info["title"])
-        source.update_thumb_url(yt_info["thumbnail"])
+        info = download_youtube_data(queue_item, job.job_dir, section)
     elif source.provider == db.SourceProvider.POCKETCASTS:
-        queue_item.update_status(db.SnippetStatus.DOWNLOADING)
-        pc_info = download_pocketcast_data(queue_item)
-        audio_filepath = pc_info["audio_filepath"]
-        source.update_title(pc_info["title"])
-        source.update_thumb_url(pc_info["thumbnail"])
-    elif source.provider == db.SourceProvider.AUDIBLE:
-        # TODO Use this pattern for YouTube and PocketCast?
-        queue_item.update_status(db.SnippetStatus.DOWNLOADING)
-        audio_filepath = audible.download_audible_data(queue_item)
-        # TODO If we don't get a filepath, we need to set status to ERROR
+        info = download_pocketcast_data(queue_item, job.job_dir, section)
+    else:
+        return None
+
+    source.update_title(info["title"])
+    source.update_thumb_url(info["thumbnail"])
+    job.audio_offset = info["audio_offset"]
+    job.partial = info["partial"]
+    return info["audio_filepath"]
 
-    if source and audio_filepath:
-        clip_path = clip_audio(source, queue_item, audio_filepath)
-        queue_item.update_status(db.SnippetStatus.TRANSCRIBING)
-        text = whisper_recognize(clip_path)
 
-        queue_item.update_text(text)
-        queue_item.update_status(db.SnippetStatus.DONE)
+def download_snippet_source(
+    snippets: list[db.Snippet],
+    job: SourceJob,
+) -> Optional[str]:
+    # TODO Handle illegal queued urls
+    queue_item = snippets[0]
+    source = db.Source.find_by_id(queue_item.source_id)
+    if source.provider == db.SourceProvider.AUDIBLE:
+        asin = db.Audible.get_audible_data(queue_item.id).asin
+        store_key = audible.get_store_key(queue_item.user_id, asin)
+        audio_filepath = files.audible_store.acquire(
+            store_key,
+            lambda: audible.download_audible_data(queue_item, job.job_dir),
+        )
+        if audio_filepath:
+            job.cache = files.audible_store
+            job.cache_key = store_key
+        if audio_filepath and audio_filepath.endswith("aax"):
+            activation_bytes = audible.get_activation_bytes(queue_item.user_id)
+            job.input_args = ("-activation_bytes", activation_bytes)
+            if Config.AUDIBLE_CONVERT_TO_M4B:
+                audible.convert_book_in_background(store_key, activation_bytes)
+        return audio_filepath
+
+    # Only whole files go into the audio cache. On a source's first miss,
+    # just the section covering this batch is fetched if the source is long
+    # enough to be worth it.
+    cache_key = str(source.id)
+    audio_filepath = files.audio_cache.acquire(cache_key)
+    if not audio_filepath and should_fetch_section(source.id):
+        section = get_clip_section(snippets)
+        audio_filepath = fetch_source_audio(source, queue_item, job, section)
+        if not audio_filepath or job.partial:
+            return audio_filepath
+        audio_filepath = files.audio_cache.put(cache_key, audio_filepath, pin=True)
+    elif not audio_filepath:
+        audio_filepath = files.audio_cache.acquire(
+            cache_key,
+            lambda: fetch_source_audio(source, queue_item, job),
+        )
+
+    if audio_filepath:
+        job.cache = files.audio_cache
+        job.cache_key = cache_key
+    return audio_filepath
+
+
+def claim_next_batch() -> list[db.Snippet]:
+    try:
+        return db.Snippet.claim_next_source_batch()
+    except Exception:
+        logging.exception("Claiming queued snippets failed.")
+        db.Session.remove()
+        return []
+
+
+def download_stage():
+    while True:
+        while snippets := claim_next_batch():
+            job = SourceJob(
+                snippets[0].source_id,
+                [snippet.id for snippet in snippets],
+                files.make_job_dir(),
+            )
+            logging.info(
+                f"Starting queue job for source {job.source_id} "
+                f"with snippets {job.snippet_ids}"
+            )
+            try:
+                job.audio_filepath = download_snippet_source(snippets, job)
+                if not job.audio_filepath:
+                    raise FileNotFoundError(f"No audio for source {job.source_id}")
+                db.Snippet.set_status(job.snippet_ids, db.SnippetStatus.PROCESSING)
+            except Exception:
+                fail_job(job)
+                continue
+            finally:
+                db.Session.remove()
+            clip_queue.put(job)
+        db.Session.remove()
+        queue_signal.wait_for_queue(Config.QUEUE_POLL_SECONDS)
 
-    files.cleanup_tmp_files()
 
+def clip_stage():
+    while True:
+        job = clip_queue.get()
+        try:
+            snippets = [db.Snippet.find_by_id(id) for id in job.snippet_ids]
+            job.clip_paths = clip_audio(
+                snippets,
+                job.audio_filepath,
+                job.job_dir,
+                job.audio_offset,
+                job.input_args,
+            )
+            release_source_audio(job)
+            db.Snippet.set_status(job.snippet_ids, db.SnippetStatus.TRANSCRIBING)
+        except Exception:
+            fail_job(job)
+            continue
+        finally:
+            db.Session.remove()
+        transcribe_queue.put(job)
+
+
+def transcribe_stage():
+    while True:
+        job = transcribe_queue.get()
+        try:
+            transcriptions = {
+                snippet_id: transcription.submit(clip_path)
+                for snippet_id, clip_path in job.clip_paths.items()
+            }
+        except Exception:
+            fail_job(job)
+            continue
+        for snippet_id, future in transcriptions.items():
+            try:
+                text = future.result()
+                # Looked up after transcribing so no transaction stays open
+                # while waiting on the model
+                queue_item = db.Snippet.find_by_id(snippet_id)
+                queue_item.update_text(text)
+                queue_item.update_status(db.SnippetStatus.DONE)
+                logging.info(f"Queue job {snippet_id} complete.")
+            except Exception:
+                logging.exception(f"Queue job {snippet_id} failed.")
+                mark_failed([snippet_id])
+        db.Session.remove()
+        files.cleanup_tmp_files(job.job_dir)
 
-def download_youtube_data(queue_item: db.Snippet) -> Optional[dict]:
+
+def download_youtube_data(
+    queue_item: db.Snippet,
+    tmp_directory: str,
+    section: Optional[tuple[int, int]] = None,
+) -> Optional[dict]:
     filename = uuid.uuid4()
-    tmp_directory = files.get_tmp_dir()
     ydl_opts = {
         "format": "mp3/bestaudio/best",
         "outtmpl": f"{tmp_directory}/{filename}.%(ext)s",
@@ -98,20 +286,34 @@ def download_youtube_data(queue_item: db.Snippet) -> Optional[dict]:
     url = queue_item.get_source_url()
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         info_dict = ydl.extract_info(url, download=False)
+    duration = info_dict.get("duration") or 0
+    if section and duration > Config.PARTIAL_DOWNLOAD_MIN_DURATION:
+        ydl_opts["download_ranges"] = yt_dlp.utils.download_range_func(
+            None, [section]
+        )
+    else:
+        section = None
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
 
     # TODO Might not always be mp3.
     info_dict["audio_filepath"] = f"{tmp_directory}/{filename}.mp3"
+    info_dict["audio_offset"] = section[0] if section else 0
+    info_dict["partial"] = bool(section)
     info_dict["url"] = url
     return info_dict
 
 
-def download_pocketcast_data(queue_item: db.Snippet):
+def download_pocketcast_data(
+    queue_item: db.Snippet,
+    tmp_directory: str,
+    section: Optional[tuple[int, int]] = None,
+):
     info_dict = {}
     url = queue_item.get_source_url()
     info_dict["url"] = url
 
-    r = requests.get(url)
+    r = downloads.get(url)
     soup = BeautifulSoup(r.text, "html.parser")
     download_button = soup.find("a", {"class": "download-button"})
     if not download_button:
@@ -119,8 +321,19 @@ def download_pocketcast_data(queue_item: db.Snippet):
         return None
 
     download_link = download_button["href"]
-    audio_filepath = files.download_file(download_link)
-    info_dict["audio_filepath"] = audio_filepath
+    if section and (
+        file_section := files.download_file_section(
+            download_link, *section, directory=tmp_directory
+        )
+    ):
+        info_dict["audio_filepath"], info_dict["audio_offset"] = file_section
+        info_dict["partial"] = True
+    else:
+        info_dict["audio_filepath"] = files.download_file(
+            download_link, directory=tmp_directory
+        )
+        info_dict["audio_offset"] = 0
+        info_dict["partial"] = False
 
     title = soup.find("meta", {"property": "og:title"})["content"]
     info_dict["title"] = title
@@ -131,10 +344,15 @@ def download_pocketcast_data(queue_item: db.Snippet):
     return info_dict
 
 
-def process_queue():
-    while True:
-        time.sleep(10)
-        if queue_item := db.Snippet.get_next_in_queue():
-            logging.info(f"Starting queue job {queue_item.id}")
-            process_snippet_task(queue_item)
-            logging.info(f"Queue job {queue_item.id} complete.")
+def start_pipeline():
+    transcription.start_engine()
+    stages = [
+        (download_stage, Config.DOWNLOAD_WORKERS),
+        (clip_stage, Config.CLIP_WORKERS),
+        (transcribe_stage, Config.TRANSCRIBE_WORKERS),
+    ]
+    for stage, num_workers in stages:
+        for _ in range(num_workers):
+            stage_thread = Thread(target=stage)
+            stage_thread.daemon = True
+            stage_thread.start()
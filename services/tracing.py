@@ -0,0 +1,44 @@
+import functools
+import inspect
+import logging
+import random
+import time
+
+from config import Config
+
+
+def traced(func, name: str):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if random.random() >= Config.TRACE_SAMPLE_RATE:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            logging.debug(f"Called {name} ({elapsed_ms:.2f}ms)")
+
+    return wrapper
+
+
+def trace_methods(cls):
+    """
+    Wraps the methods defined on cls so that a sample of their calls is logged
+    with timings. Does nothing unless Config.TRACE_METHODS is enabled, so
+    tracing costs nothing when it's off.
+    """
+    if not Config.TRACE_METHODS:
+        return cls
+
+    for attr_name, attr in list(vars(cls).items()):
+        if attr_name.startswith("__"):
+            continue
+        name = f"{cls.__name__}.{attr_name}"
+        if isinstance(attr, staticmethod):
+            setattr(cls, attr_name, staticmethod(traced(attr.__func__, name)))
+        elif isinstance(attr, classmethod):
+            setattr(cls, attr_name, classmethod(traced(attr.__func__, name)))
+        elif inspect.isfunction(attr):
+            setattr(cls, attr_name, traced(attr, name))
+    return cls
@@ -0,0 +1,76 @@
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Optional
+
+from config import Config
+
+# Each engine process loads the Whisper model once and keeps it in memory, so
+# model loading stays out of per-clip latency and inference runs outside the
+# web process' GIL.
+_model = None
+_engine: Optional[ProcessPoolExecutor] = None
+_engine_lock = Lock()
+
+
+def _load_model(model_name: str, num_threads: int):
+    global _model
+    import torch
+    import whisper
+
+    torch.set_num_threads(num_threads)
+    _model = whisper.load_model(model_name)
+
+
+def _transcribe(clip_path: str) -> str:
+    import torch
+
+    result = _model.transcribe(clip_path, fp16=torch.cuda.is_available())
+    return result["text"]
+
+
+def _warm_up():
+    return _model is not None
+
+
+def get_engine() -> ProcessPoolExecutor:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ProcessPoolExecutor(
+                max_workers=Config.TRANSCRIBE_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_model,
+                initargs=(Config.WHISPER_MODEL, Config.WHISPER_THREADS),
+            )
+        return _engine
+
+
+def replace_engine(broken: ProcessPoolExecutor):
+    """
+    Drops the engine if it's still the broken one, so the next get_engine
+    starts a new one. A pool stays broken once any of its workers dies.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is broken:
+            _engine = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def start_engine():
+    engine = get_engine()
+    for _ in range(Config.TRANSCRIBE_PROCESSES):
+        engine.submit(_warm_up)
+
+
+def submit(clip_path: str) -> Future:
+    engine = get_engine()
+    try:
+        return engine.submit(_transcribe, clip_path)
+    except BrokenProcessPool:
+        logging.warning("A transcription process died, restarting the engine")
+        replace_engine(engine)
+        return get_engine().submit(_transcribe, clip_path)
@@ -0,0 +1,183 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from models import AudibleBookState, AudibleLibraryBook, AudibleSyncRecord
+from services import audible
+
+BOOKS = [
+    {"asin": "B000000001", "title": "Played", "product_images": {}},
+    {"asin": "B000000002", "title": "Not started", "product_images": {}},
+]
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeClient:
+    def __init__(self, last_updated):
+        self.last_updated = last_updated
+        self.bookmark_requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get(self, path, response_callback=None, **params):
+        if path == "1.0/annotations/lastpositions":
+            return {
+                "asin_last_position_heard_annots": [
+                    {
+                        "asin": "B000000001",
+                        "last_position_heard": {"last_updated": self.last_updated},
+                    },
+                    {"asin": "B000000002", "last_position_heard": {}},
+                ]
+            }
+        self.bookmark_requests.append(path.rsplit("=", 1)[1])
+        return FakeResponse(
+            {
+                "payload": {
+                    "records": [
+                        {
+                            "type": "audible.clip",
+                            "creationTime": "2024-01-01 10:00:00.0",
+                            "startPosition": "10000",
+                            "endPosition": "40000",
+                        }
+                    ]
+                }
+            }
+        )
+
+
+def test_only_changed_books_are_fetched(user):
+    client = FakeClient("2024-01-01")
+    clips, states = audible.get_all_clips(user, client, BOOKS)
+
+    assert client.bookmark_requests == ["B000000001", "B000000002"]
+    assert len(clips) == 2
+    assert states == {"B000000001": "2024-01-01", "B000000002": audible.NOT_STARTED}
+
+    AudibleBookState.update_user_states(user, states)
+    client = FakeClient("2024-01-01")
+    assert audible.get_all_clips(user, client, BOOKS) == ([], {})
+    assert client.bookmark_requests == []
+
+    client = FakeClient("2024-01-02")
+    clips, states = audible.get_all_clips(user, client, BOOKS)
+    assert client.bookmark_requests == ["B000000001"]
+    assert states == {"B000000001": "2024-01-02"}
+
+
+def test_books_are_fetched_when_their_state_is_unknown(user):
+    class FailingClient(FakeClient):
+        def get(self, path, **kwargs):
+            if path == "1.0/annotations/lastpositions":
+                raise ConnectionError("timed out")
+            return super().get(path, **kwargs)
+
+    AudibleBookState.update_user_states(user, {"B000000001": "2024-01-01"})
+    client = FailingClient("2024-01-01")
+    clips, states = audible.get_all_clips(user, client, BOOKS)
+
+    assert client.bookmark_requests == ["B000000001", "B000000002"]
+    assert states == {}
+
+
+def test_states_are_saved_only_after_ingesting(user, monkeypatch):
+    clip = audible.AudibleClip(
+        "B000000001", "Played", 10, 40, "2024-01-01 10:00:00.0", ""
+    )
+    monkeypatch.setattr(audible, "user_has_audible_auth", lambda user_id: True)
+    monkeypatch.setattr(
+        audible,
+        "get_new_clips",
+        lambda user_id: ([clip], {"B000000001": "2024-01-01"}, {"B000000001"}),
+    )
+
+    def fail_ingest(user_id, clips):
+        raise ConnectionError("database went away")
+
+    monkeypatch.setattr(audible, "ingest_clips", fail_ingest)
+    with pytest.raises(ConnectionError):
+        audible.sync_user(user)
+    assert AudibleBookState.find_user_states(user) == {}
+    assert AudibleSyncRecord.get_user_last_sync(user) is None
+    assert AudibleLibraryBook.find_user_asins(user) == set()
+
+    monkeypatch.setattr(audible, "ingest_clips", lambda user_id, clips: 1)
+    audible.sync_user(user)
+    assert AudibleBookState.find_user_states(user) == {"B000000001": "2024-01-01"}
+    assert AudibleSyncRecord.get_user_last_sync(user) is not None
+    assert AudibleLibraryBook.find_user_asins(user) == {"B000000001"}
+
+
+def test_only_books_new_to_the_listing_keep_earlier_clips(user, monkeypatch):
+    clips = [
+        audible.AudibleClip(book["asin"], "Book", 10, 40, "2024-01-01 10:00:00.0", "")
+        for book in BOOKS
+    ]
+    monkeypatch.setattr(audible, "get_audible_auth", lambda user_id: None)
+    monkeypatch.setattr(audible, "save_credentials", lambda user_id: None)
+    monkeypatch.setattr(audible.audible, "Client", lambda auth: FakeClient(""))
+    monkeypatch.setattr(audible, "get_library_items", lambda user_id, client: BOOKS)
+    monkeypatch.setattr(
+        audible, "get_all_clips", lambda user_id, client, books: (clips, {})
+    )
+    AudibleSyncRecord.update_user_sync_record(user)
+
+    # Books listed before the listing was recorded aren't new
+    new_clips, _, new_asins = audible.get_new_clips(user)
+    assert new_clips == []
+    assert new_asins == {"B000000001", "B000000002"}
+
+    AudibleLibraryBook.add_user_asins(user, {"B000000001"})
+    new_clips, _, new_asins = audible.get_new_clips(user)
+    assert [clip.asin for clip in new_clips] == ["B000000002"]
+    assert new_asins == {"B000000002"}
+
+
+def test_the_scheduler_survives_database_errors(user, monkeypatch):
+    class Stop(Exception):
+        pass
+
+    class FakeEvent:
+        waits = 0
+
+        def wait(self, timeout):
+            self.waits += 1
+            if self.waits == 2:
+                raise Stop
+
+        def clear(self):
+            pass
+
+    get_all = audible.db.User.get_all
+    calls = []
+
+    def get_all_once_locked():
+        calls.append(None)
+        if len(calls) == 1:
+            raise OperationalError("SELECT", {}, Exception("database is locked"))
+        return get_all()
+
+    synced = []
+    monkeypatch.setattr(audible.db.User, "get_all", get_all_once_locked)
+    monkeypatch.setattr(audible, "run_user_sync", synced.append)
+    monkeypatch.setattr(audible, "_schedule_event", FakeEvent())
+    monkeypatch.setattr(audible, "_next_sync", {})
+    monkeypatch.setattr(audible, "_syncing", set())
+
+    with pytest.raises(Stop):
+        audible.sync_with_audible()
+
+    assert synced == [user]
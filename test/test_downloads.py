@@ -0,0 +1,82 @@
+import requests
+
+from services import downloads
+
+
+class FakeResponse:
+    def __init__(self, chunks, status_code=206):
+        self.chunks = chunks
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+def test_download_range_writes_from_the_start_of_the_file(monkeypatch, tmp_path):
+    body = bytes(range(100))
+    requested = []
+
+    def get(url, headers, stream):
+        requested.append(headers["Range"])
+        return FakeResponse([body])
+
+    monkeypatch.setattr(downloads, "get", get)
+    filepath = tmp_path / "section.mp3"
+
+    url = "https://host/a.mp3"
+    assert downloads.download_range(url, filepath, 5_000_000, 5_000_099)
+    assert requested == ["bytes=5000000-5000099"]
+    assert filepath.read_bytes() == body
+
+
+def test_download_range_resumes_where_the_connection_dropped(monkeypatch, tmp_path):
+    responses = [
+        FakeResponse([b"abc", requests.ConnectionError("reset")]),
+        FakeResponse([b"def"]),
+    ]
+    requested = []
+
+    def get(url, headers, stream):
+        requested.append(headers["Range"])
+        return responses.pop(0)
+
+    monkeypatch.setattr(downloads, "get", get)
+    filepath = tmp_path / "section.mp3"
+
+    assert downloads.download_range("https://host/a.mp3", filepath, 1000, 1005)
+    assert requested == ["bytes=1000-1005", "bytes=1003-1005"]
+    assert filepath.read_bytes() == b"abcdef"
+
+
+def test_download_range_needs_a_partial_response(monkeypatch, tmp_path):
+    monkeypatch.setattr(downloads, "get", lambda *a, **kw: FakeResponse([], 200))
+
+    assert not downloads.download_range("https://host/a.mp3", tmp_path / "a", 10, 20)
+
+
+def test_segments_are_written_in_place(monkeypatch, tmp_path):
+    body = bytes(range(256)) * 4
+
+    def get(url, headers, stream):
+        start, end = headers["Range"][len("bytes=") :].split("-")
+        return FakeResponse([body[int(start) : int(end) + 1]])
+
+    monkeypatch.setattr(downloads, "get", get)
+    monkeypatch.setattr(downloads.Config, "DOWNLOAD_SEGMENTS", 3)
+    filepath = tmp_path / "whole.mp3"
+
+    downloads.download_segmented("https://host/a.mp3", filepath, len(body))
+
+    assert filepath.read_bytes() == body
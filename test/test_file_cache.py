@@ -0,0 +1,79 @@
+import os
+
+from services.file_cache import FileCache
+
+
+def make_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return path
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), 100)
+    cache.put("a", make_file(tmp_path, "a.mp3", 40))
+    cache.put("b", make_file(tmp_path, "b.mp3", 40))
+    cache.get("a")
+
+    cache.put("c", make_file(tmp_path, "c.mp3", 40))
+
+    assert cache.get("a")
+    assert cache.get("b") is None
+    assert cache.get("c")
+
+
+def test_fetched_file_larger_than_the_cache_survives_until_released(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), 100)
+
+    path = cache.acquire("k", lambda: make_file(tmp_path, "k.mp3", 150))
+
+    assert os.path.exists(path)
+    cache.release("k")
+    assert not os.path.exists(path)
+
+
+def test_pinned_files_are_not_evicted(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), 100)
+    pinned = cache.acquire("a", lambda: make_file(tmp_path, "a.mp3", 60))
+
+    cache.put("b", make_file(tmp_path, "b.mp3", 60))
+
+    assert os.path.exists(pinned)
+    assert cache.get("b") is None
+    cache.release("a")
+    assert cache.acquire("a") == pinned
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_miss_without_fetch_returns_none(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), 100)
+
+    assert cache.acquire("a") is None
+    assert cache.acquire("a", lambda: None) is None
+    assert cache.misses == 2
+
+
+def test_replaced_file_is_deleted_once_released(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), 100)
+    aax_path = cache.acquire("book", lambda: make_file(tmp_path, "book.aax", 10))
+
+    m4b_path = cache.put("book", make_file(tmp_path, "book.m4b", 10))
+
+    assert os.path.exists(aax_path)
+    assert cache.get("book") == m4b_path
+    cache.release("book")
+    assert not os.path.exists(aax_path)
+
+
+def test_newest_file_per_key_is_kept_on_restart(tmp_path):
+    directory = tmp_path / "cache"
+    directory.mkdir()
+    old_path = make_file(directory, "book.aax", 10)
+    new_path = make_file(directory, "book.m4b", 10)
+    os.utime(old_path, (1, 1))
+
+    cache = FileCache(str(directory), 100)
+
+    assert cache.get("book") == new_path
+    assert not os.path.exists(old_path)
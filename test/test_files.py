@@ -0,0 +1,78 @@
+import io
+import subprocess
+
+import pytest
+
+from services import files
+
+
+def test_clip_to_wavs_raises_when_ffmpeg_fails(monkeypatch, tmp_path):
+    def run(args, **kwargs):
+        return subprocess.CompletedProcess(args, 1, "", "Invalid data found")
+
+    monkeypatch.setattr(subprocess, "run", run)
+
+    with pytest.raises(RuntimeError, match="Invalid data found"):
+        files.clip_to_wavs("source.mp3", [(10, 40), (60, 90)], str(tmp_path))
+
+
+def test_probes_that_time_out_fall_back_to_whole_downloads(monkeypatch):
+    def run(args, timeout, **kwargs):
+        assert "-rw_timeout" in args
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    monkeypatch.setattr(subprocess, "run", run)
+
+    assert files.probe_audio("https://host/a.mp3") is None
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_id3_tag_size_is_read_from_the_header(monkeypatch):
+    header = b"ID3\x04\x00\x00" + bytes([0, 0, 0x02, 0x01])
+    monkeypatch.setattr(files.downloads, "get", lambda *a, **kw: FakeResponse(header))
+
+    assert files.get_id3_tag_size("https://host/episode.mp3") == 10 + 257
+
+
+def test_no_id3_tag(monkeypatch):
+    monkeypatch.setattr(
+        files.downloads, "get", lambda *a, **kw: FakeResponse(b"\xff\xfb\x90\x00")
+    )
+
+    assert files.get_id3_tag_size("https://host/episode.mp3") == 0
+
+
+def test_section_offsets_skip_the_id3_tag(monkeypatch, tmp_path):
+    ranges = []
+    monkeypatch.setattr(files, "probe_audio", lambda url: (3600.0, 361_000, "mp3"))
+    monkeypatch.setattr(files, "get_id3_tag_size", lambda url: 1000)
+    monkeypatch.setattr(
+        files.downloads,
+        "download_range",
+        lambda url, path, start, end: ranges.append((start, end)) or True,
+    )
+
+    path, offset = files.download_file_section(
+        "https://host/episode.mp3", 1800, 1900, str(tmp_path)
+    )
+
+    assert ranges == [(1000 + 180_000, 1000 + 190_000)]
+    assert offset == 1800
+
+
+def test_only_long_mp3s_are_fetched_in_sections(monkeypatch, tmp_path):
+    monkeypatch.setattr(files, "probe_audio", lambda url: (3600.0, 360_000, "mov,mp4"))
+    assert files.download_file_section("https://host/a.m4a", 60, 90) is None
+
+    monkeypatch.setattr(files, "probe_audio", lambda url: (600.0, 60_000, "mp3"))
+    assert files.download_file_section("https://host/a.mp3", 60, 90) is None
@@ -0,0 +1,67 @@
+from models import Audible, Snippet, SnippetStatus, Source, SyncRecord
+from services import markdown
+from services.markdown import get_source_markdown
+
+
+def add_done_snippet(user_id, source_id, start, text):
+    snippet = Snippet.add(user_id, source_id, start, start + 30)
+    snippet.update_text(text)
+    snippet.update_status(SnippetStatus.DONE)
+    return snippet
+
+
+def clip(asin):
+    return {
+        "url": f"file://{asin}.aax",
+        "title": asin,
+        "thumb_url": "",
+        "asin": asin,
+        "start_time": 10,
+        "end_time": 40,
+    }
+
+
+def test_markdown_is_cached_until_a_snippet_changes(user):
+    source = Source.add("https://youtu.be/a", title="Talk")
+    snippet = add_done_snippet(user, source.id, 10, " First")
+
+    first = get_source_markdown(source.id, user)
+    assert first.body == (
+        "# Talk\n\n[Talk](https://youtu.be/a)\n\n"
+        "![thumbnail](None)\n\n"
+        "First [10](https://youtu.be/a?t=10)\n\n"
+    )
+    assert get_source_markdown(source.id, user) is first
+
+    Snippet.find_by_id(snippet.id).update_text("Edited")
+    edited = get_source_markdown(source.id, user)
+    assert "Edited [10]" in edited.body
+    assert edited.etag != first.etag
+
+
+def test_latest_markdown_changes_after_sync(user):
+    source = Source.add("https://youtu.be/a", title="Talk")
+    add_done_snippet(user, source.id, 10, "First")
+    exclusions = ["title", "thumbnail"]
+
+    assert get_source_markdown(source.id, user, exclusions, latest=True).body
+    SyncRecord.update_user_source(user, source.id)
+    assert get_source_markdown(source.id, user, exclusions, latest=True).body == ""
+
+
+def test_bulk_changes_only_drop_the_sources_they_touch(user, monkeypatch):
+    first = Source.add("https://youtu.be/a", title="A")
+    snippet_id = add_done_snippet(user, first.id, 10, "First").id
+    invalidated = []
+    monkeypatch.setattr(markdown, "invalidate", invalidated.append)
+
+    Snippet.set_status([snippet_id], SnippetStatus.DONE)
+    Snippet.add(user, first.id, 20, 50)
+    Snippet.claim_next_source_batch()
+    SyncRecord.update_user_source(user, first.id)
+    Source.add("https://youtu.be/a")
+    Audible.bulk_add(user, [clip("B1")])
+    second = Source.add("https://youtu.be/b")
+
+    audible_source = Source.find_by_url("file://B1.aax")
+    assert invalidated == [{first.id}] * 5 + [{audible_source.id}, {second.id}]
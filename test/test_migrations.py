@@ -0,0 +1,55 @@
+from sqlalchemy import inspect, text
+
+import migrations
+from models import Session, Snippet, SnippetStatus, Source, db
+
+
+def test_create_stamps_an_empty_database(database):
+    db.metadata.drop_all(database)
+
+    migrations.create(database)
+
+    assert migrations.get_engine_version(database) == migrations.LATEST_VERSION
+
+
+def test_create_migrates_an_existing_database(user, database):
+    source = Source.add("https://youtu.be/a")
+    Session.remove()
+    with database.begin() as connection:
+        connection.execute(text("DROP INDEX uq_snippet_user_id_source_id_times"))
+        for _ in range(2):
+            connection.execute(
+                text(
+                    "INSERT INTO snippet (user_id, source_id, start_time, end_time) "
+                    "VALUES (:user_id, :source_id, 10, 40)"
+                ),
+                {"user_id": user, "source_id": source.id},
+            )
+
+    migrations.create(database)
+
+    assert migrations.get_engine_version(database) == migrations.LATEST_VERSION
+    indexes = [index["name"] for index in inspect(database).get_indexes("snippet")]
+    assert "uq_snippet_user_id_source_id_times" in indexes
+    Snippet.add(user, source.id, 10, 40)
+    Snippet.add(user, source.id, 20, 50)
+    assert Session.query(Snippet).count() == 2
+
+
+def test_source_activity_is_filled_in_for_existing_snippets(user, database):
+    sources = [Source.add(f"https://youtu.be/{i}") for i in range(2)]
+    snippet_ids = [
+        Snippet.add(user, source.id, start, start + 30).id
+        for source in sources
+        for start in [10, 20]
+    ]
+    Snippet.set_status(snippet_ids[:3], SnippetStatus.DONE)
+    Session.remove()
+    with database.begin() as connection:
+        connection.execute(text("DELETE FROM source_activity"))
+        migrations.set_version(connection, migrations.LATEST_VERSION - 1)
+
+    migrations.migrate(database)
+
+    sources, _ = Source.get_user_sources_snippets(user)
+    assert [len(source.snippets) for source in sources] == [1, 2]
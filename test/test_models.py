@@ -0,0 +1,223 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from models import (
+    Audible,
+    AudibleSyncRecord,
+    Session,
+    Snippet,
+    SnippetStatus,
+    Source,
+    SourceProvider,
+    SyncRecord,
+)
+
+
+def add_snippets(user_id, url, times):
+    source = Source.add(url)
+    return [Snippet.add(user_id, source.id, start, start + 30) for start in times]
+
+
+def test_snippet_status_round_trip(user):
+    snippet = add_snippets(user, "https://youtu.be/a", [10])[0]
+    assert snippet.status == SnippetStatus.QUEUED
+
+    snippet_id = snippet.id
+    Snippet.set_status([snippet_id], SnippetStatus.DONE)
+    Session.remove()
+    snippet = Snippet.find_by_id(snippet_id)
+    assert snippet.status == SnippetStatus.DONE
+    assert snippet.created_at is not None
+
+
+def test_claim_next_source_batch(user):
+    first = add_snippets(user, "https://youtu.be/a", [30, 10])
+    add_snippets(user, "https://youtu.be/b", [10])
+
+    claimed = Snippet.claim_next_source_batch()
+
+    assert [snippet.id for snippet in claimed] == [first[1].id, first[0].id]
+    assert all(snippet.status == SnippetStatus.DOWNLOADING for snippet in claimed)
+    assert Snippet.claim_next_source_batch()[0].source_id != first[0].source_id
+    assert Snippet.claim_next_source_batch() == []
+
+
+def test_claims_are_capped_at_the_batch_size(user, monkeypatch):
+    monkeypatch.setattr(Config, "CLIP_BATCH_SIZE", 2)
+    snippets = add_snippets(user, "https://youtu.be/a", [30, 10, 20])
+
+    first = Snippet.claim_next_source_batch()
+    second = Snippet.claim_next_source_batch()
+
+    assert [snippet.id for snippet in first] == [snippets[1].id, snippets[0].id]
+    assert [snippet.id for snippet in second] == [snippets[2].id]
+
+
+def test_concurrent_claims_never_share_snippets(user):
+    for i in range(10):
+        add_snippets(user, f"https://youtu.be/{i}", [10, 20])
+    Session.remove()
+
+    def claim():
+        try:
+            return [snippet.id for snippet in Snippet.claim_next_source_batch()]
+        finally:
+            Session.remove()
+
+    with ThreadPoolExecutor(4) as executor:
+        batches = list(executor.map(lambda _: claim(), range(12)))
+
+    claimed = [snippet_id for batch in batches for snippet_id in batch]
+    assert len(claimed) == len(set(claimed)) == 20
+
+
+def test_user_sources_pages(user):
+    for i in range(5):
+        snippets = add_snippets(user, f"https://youtu.be/{i}", [10])
+        Snippet.set_status([snippets[0].id], SnippetStatus.DONE)
+
+    sources, cursor = Source.get_user_sources_snippets(user, limit=3)
+    assert [source.url for source in sources] == [
+        "https://youtu.be/4",
+        "https://youtu.be/3",
+        "https://youtu.be/2",
+    ]
+
+    sources, cursor = Source.get_user_sources_snippets(user, cursor=cursor, limit=3)
+    assert [source.url for source in sources] == [
+        "https://youtu.be/1",
+        "https://youtu.be/0",
+    ]
+    assert cursor is None
+
+
+def test_sources_move_up_when_snippets_are_done_or_deleted(user):
+    first = add_snippets(user, "https://youtu.be/a", [10])
+    second = add_snippets(user, "https://youtu.be/b", [10])
+    first += add_snippets(user, "https://youtu.be/a", [20])
+    Snippet.set_status([first[0].id, second[0].id], SnippetStatus.DONE)
+    first_ids = [snippet.id for snippet in first]
+
+    sources, _ = Source.get_user_sources_snippets(user)
+    assert [source.url for source in sources] == [
+        "https://youtu.be/b",
+        "https://youtu.be/a",
+    ]
+
+    Snippet.find_by_id(first_ids[1]).update_status(SnippetStatus.DONE)
+    sources, _ = Source.get_user_sources_snippets(user)
+    assert [source.url for source in sources] == [
+        "https://youtu.be/a",
+        "https://youtu.be/b",
+    ]
+
+    Snippet.find_by_id(first_ids[1]).delete_from_db()
+    sources, _ = Source.get_user_sources_snippets(user)
+    assert [source.url for source in sources] == [
+        "https://youtu.be/b",
+        "https://youtu.be/a",
+    ]
+
+    Snippet.find_by_id(first_ids[0]).delete_from_db()
+    sources, _ = Source.get_user_sources_snippets(user)
+    assert [source.url for source in sources] == ["https://youtu.be/b"]
+
+
+def test_adding_a_source_or_snippet_twice_returns_the_first(user):
+    source = Source.add("https://youtu.be/a?t=10")
+    snippet = Snippet.add(user, source.id, 10, 40)
+    Snippet.set_status([snippet.id], SnippetStatus.DONE)
+
+    same_source = Source.add("https://youtu.be/a?t=20", title="Other")
+    same_snippet = Snippet.add(user, source.id, 10, 40)
+
+    assert same_source.id == source.id
+    assert same_source.provider == SourceProvider.YOUTUBE
+    assert same_source.title is None
+    assert same_snippet.id == snippet.id
+    assert same_snippet.status == SnippetStatus.DONE
+    assert Session.query(Snippet).count() == 1
+
+
+def test_changes_to_added_rows_are_saved(user):
+    source = Source.add("https://youtu.be/a")
+    snippet = Snippet.add(user, source.id, 10, 40)
+    snippet_id, source_id = snippet.id, source.id
+    snippet.update_text("Saved")
+    source.update_title("Talk")
+
+    Session.remove()
+    assert Snippet.find_by_id(snippet_id).text == "Saved"
+    assert Source.find_by_id(source_id).title == "Talk"
+
+
+def test_concurrent_adds_create_one_row(user):
+    def add():
+        try:
+            source = Source.add("https://youtu.be/a")
+            return Snippet.add(user, source.id, 10, 40).id
+        finally:
+            Session.remove()
+
+    with ThreadPoolExecutor(4) as executor:
+        snippet_ids = set(executor.map(lambda _: add(), range(8)))
+
+    assert len(snippet_ids) == 1
+    assert Session.query(Source).count() == 1
+
+
+def test_sync_records_are_updated_in_place(user):
+    source = Source.add("https://youtu.be/a")
+    first = SyncRecord.update_user_source(user, source.id)
+    second = SyncRecord.update_user_source(user, source.id)
+    AudibleSyncRecord.update_user_sync_record(user)
+    AudibleSyncRecord.update_user_sync_record(user)
+
+    assert second.id == first.id
+    assert second.synced_at >= first.synced_at
+    assert Session.query(SyncRecord).count() == 1
+    assert Session.query(AudibleSyncRecord).count() == 1
+
+
+def test_bulk_add_skips_clips_the_user_has(user):
+    def clip(asin, start_time):
+        return {
+            "url": f"file://{asin}.aax?x=1",
+            "title": asin,
+            "thumb_url": "",
+            "asin": asin,
+            "start_time": start_time,
+            "end_time": start_time + 30,
+        }
+
+    assert Audible.bulk_add(user, [clip("B1", 10), clip("B1", 10)]) == 1
+    source = Source.add("file://B1.aax", SourceProvider.AUDIBLE)
+    Snippet.add(user, source.id, 20, 50)
+
+    assert Audible.bulk_add(user, [clip("B1", 10), clip("B1", 20), clip("B2", 10)]) == 1
+    assert Audible.bulk_add(user, []) == 0
+
+    assert [s.provider for s in Session.query(Source)] == [SourceProvider.AUDIBLE] * 2
+    snippets = Session.query(Snippet).order_by(Snippet.id).all()
+    assert [(s.source_id, s.start_time) for s in snippets] == [
+        (source.id, 10),
+        (source.id, 20),
+        (snippets[2].source_id, 10),
+    ]
+    assert snippets[0].status == SnippetStatus.QUEUED
+    audible_rows = {row.snippet_id: row.asin for row in Session.query(Audible)}
+    assert audible_rows == {snippets[0].id: "B1", snippets[2].id: "B2"}
+
+
+def test_status_progress_follows_the_pipeline():
+    pipeline = [
+        SnippetStatus.QUEUED,
+        SnippetStatus.DOWNLOADING,
+        SnippetStatus.PROCESSING,
+        SnippetStatus.TRANSCRIBING,
+        SnippetStatus.DONE,
+    ]
+    progress = [status.progress for status in pipeline]
+
+    assert progress == sorted(progress)
+    assert all(status.progress <= 100 for status in SnippetStatus)
@@ -0,0 +1,79 @@
+from sqlalchemy.exc import OperationalError
+
+from config import Config
+from models import Audible, Session, Snippet, SnippetStatus, Source, User
+from services import source_processors
+from services.file_cache import FileCache
+
+
+def raise_locked(*args):
+    raise OperationalError("UPDATE snippet", {}, Exception("database is locked"))
+
+
+def test_claim_errors_leave_the_stage_running(database, monkeypatch):
+    monkeypatch.setattr(Snippet, "claim_next_source_batch", raise_locked)
+
+    assert source_processors.claim_next_batch() == []
+
+
+def test_mark_failed_swallows_database_errors(user, monkeypatch):
+    source = Source.add("https://youtu.be/a")
+    snippet_id = Snippet.add(user, source.id, 10, 40).id
+
+    source_processors.mark_failed([snippet_id])
+    Session.remove()
+    assert Snippet.find_by_id(snippet_id).status == SnippetStatus.ERROR
+
+    monkeypatch.setattr(Snippet, "set_status", raise_locked)
+    source_processors.mark_failed([snippet_id])
+
+
+def test_only_the_first_fetch_of_a_source_is_partial(monkeypatch):
+    monkeypatch.setattr(source_processors, "_sections_fetched", set())
+
+    assert source_processors.should_fetch_section(1)
+    assert not source_processors.should_fetch_section(1)
+    assert source_processors.should_fetch_section(2)
+
+    monkeypatch.setattr(Config, "PARTIAL_DOWNLOADS", False)
+    assert not source_processors.should_fetch_section(3)
+
+
+def test_audible_books_are_stored_per_user(user, monkeypatch, tmp_path):
+    other_user = User.create("other@domain.com", "password").id
+    clip = {
+        "url": "file://B000000001.aax",
+        "title": "Book",
+        "thumb_url": "",
+        "asin": "B000000001",
+        "start_time": 10,
+        "end_time": 40,
+    }
+    Audible.bulk_add(user, [dict(clip)])
+    Audible.bulk_add(other_user, [dict(clip)])
+
+    def download_audible_data(queue_item, directory):
+        book_path = tmp_path / f"{queue_item.user_id}.aax"
+        book_path.write_text(str(queue_item.user_id))
+        return str(book_path)
+
+    store = FileCache(str(tmp_path / "store"), 1 << 20)
+    monkeypatch.setattr(source_processors.files, "audible_store", store)
+    monkeypatch.setattr(
+        source_processors.audible, "download_audible_data", download_audible_data
+    )
+    monkeypatch.setattr(
+        source_processors.audible,
+        "get_activation_bytes",
+        lambda user_id: f"bytes-{user_id}",
+    )
+
+    for user_id in [user, other_user]:
+        snippets = Session.query(Snippet).filter_by(user_id=user_id).all()
+        job = source_processors.SourceJob(snippets[0].source_id, [], str(tmp_path))
+        book_path = source_processors.download_snippet_source(snippets, job)
+
+        with open(book_path) as f:
+            assert f.read() == str(user_id)
+        assert job.input_args == ("-activation_bytes", f"bytes-{user_id}")
+        job.cache.release(job.cache_key)
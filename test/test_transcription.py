@@ -0,0 +1,28 @@
+from concurrent.futures.process import BrokenProcessPool
+
+from services import transcription
+
+
+class FakeEngine:
+    def __init__(self, broken=False, **kwargs):
+        self.broken = broken
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        if self.broken:
+            raise BrokenProcessPool("A child process terminated abruptly")
+        return args
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def test_a_broken_engine_is_replaced(monkeypatch):
+    broken = FakeEngine(broken=True)
+    monkeypatch.setattr(transcription, "_engine", broken)
+    monkeypatch.setattr(transcription, "ProcessPoolExecutor", FakeEngine)
+
+    assert transcription.submit("clip.wav") == ("clip.wav",)
+    assert broken.shut_down
+    assert transcription.get_engine() is not broken
+    assert transcription.submit("clip.wav") == ("clip.wav",)